@@ -1,16 +1,30 @@
 """The yamaha_musiccast component."""
+import asyncio
+import json
 import logging
 import voluptuous as vol
 
 from homeassistant.const import ATTR_ENTITY_ID
 from homeassistant.helpers import config_validation as cv
+from homeassistant.helpers.event import call_later
+from .helpers import METRICS, start_recording, stop_recording
 
 DOMAIN = 'musiccast_yamaha'
 
 SERVICE_JOIN = 'join'
 SERVICE_UNJOIN = 'unjoin'
+SERVICE_APPLY_SNAPSHOT = 'apply_snapshot'
+SERVICE_DUMP_METRICS = 'dump_metrics'
+SERVICE_RECORD_EVENTS = 'record_events'
 
+EVENT_SNAPSHOT_APPLIED = 'musiccast_yamaha_snapshot_applied'
+
+ATTR_DURATION = 'duration'
 ATTR_MASTER = 'master'
+ATTR_POWER = 'power'
+ATTR_SNAPSHOT = 'snapshot'
+ATTR_SOURCE = 'source'
+ATTR_VOLUME = 'volume'
 
 SERVICE_SCHEMA = vol.Schema({
     vol.Optional(ATTR_ENTITY_ID): cv.entity_ids,
@@ -20,31 +34,55 @@ JOIN_SERVICE_SCHEMA = SERVICE_SCHEMA.extend({
     vol.Required(ATTR_MASTER): cv.entity_id,
 })
 
+SNAPSHOT_ENTRY_SCHEMA = vol.Schema({
+    vol.Required(ATTR_ENTITY_ID): cv.entity_id,
+    vol.Optional(ATTR_POWER): cv.boolean,
+    vol.Optional(ATTR_SOURCE): cv.string,
+    vol.Optional(ATTR_VOLUME): vol.All(vol.Coerce(float),
+                                       vol.Range(min=0, max=1)),
+    vol.Optional(ATTR_MASTER): vol.Any(cv.entity_id, vol.In([''])),
+})
+
+APPLY_SNAPSHOT_SCHEMA = vol.Schema({
+    vol.Required(ATTR_SNAPSHOT): vol.All(cv.ensure_list,
+                                         [SNAPSHOT_ENTRY_SCHEMA]),
+})
+
+RECORD_EVENTS_SCHEMA = vol.Schema({
+    vol.Optional(ATTR_DURATION, default=60): vol.All(
+        vol.Coerce(int), vol.Range(min=1, max=3600)),
+})
+
+METRICS_FILE = 'musiccast_yamaha_metrics.json'
+EVENTS_FILE = 'musiccast_yamaha_events.mcev'
+
 _LOGGER = logging.getLogger(__name__)
 
 
 def setup(hass, config):
     """Handle service configuration."""
 
-    def service_handle(service):
+    async def async_service_handle(service):
         """Handle services."""
         _LOGGER.debug("service_handle from id: %s",
                       service.data.get('entity_id'))
         entity_ids = service.data.get('entity_id')
-        entities = hass.data[DOMAIN].entities
+        registry = hass.data[DOMAIN].entities
         if entity_ids:
-            entities = [e for e in entities if e.entity_id in entity_ids]
+            entities = [registry.get(entity_id) for entity_id in entity_ids
+                        if registry.get(entity_id)]
+        else:
+            entities = list(registry)
 
         if service.service == SERVICE_JOIN:
-            master = [e for e in hass.data[DOMAIN].entities
-                      if e.entity_id == service.data[ATTR_MASTER]]
+            master = registry.get(service.data[ATTR_MASTER])
             if master:
                 client_entities = [e for e in entities
-                                   if e.entity_id != master[0].entity_id]
+                                   if e.entity_id != master.entity_id]
                 _LOGGER.debug("**JOIN** set clients %s for master %s",
                               [e.entity_id for e in client_entities],
-                              master[0].ip_address)
-                master[0].join_add(client_entities)
+                              master.ip_address)
+                await master.async_join_add(client_entities)
 
         elif service.service == SERVICE_UNJOIN:
             _LOGGER.debug("**UNJOIN** entities: %s", entities)
@@ -52,14 +90,118 @@ def setup(hass, config):
                        if entities.is_master]
             if masters:
                 for master in masters:
-                    master.unjoin()
+                    await master.async_unjoin()
             else:
                 for entity in entities:
-                    entity.unjoin()
+                    await entity.async_unjoin()
+
+    async def async_apply_snapshot(service):
+        """Bring many entities to a desired state at once."""
+        registry = hass.data[DOMAIN].entities
+        results = {}
+        entries = []
+        for entry in service.data[ATTR_SNAPSHOT]:
+            entity = registry.get(entry[ATTR_ENTITY_ID])
+            if entity:
+                entries.append((entity, entry))
+            else:
+                results[entry[ATTR_ENTITY_ID]] = {'error': 'unknown entity'}
+
+        async def apply_state(entity, entry):
+            """Send the power, input and volume commands of an entity."""
+            try:
+                sent = await entity.async_apply_state(
+                    power=entry.get(ATTR_POWER),
+                    source=entry.get(ATTR_SOURCE),
+                    volume=entry.get(ATTR_VOLUME))
+            except Exception as err:  # pylint: disable=broad-except
+                results[entity.entity_id] = {'error': repr(err)}
+            else:
+                results[entity.entity_id] = {'sent': sent}
 
+        await asyncio.gather(*[apply_state(entity, entry)
+                               for entity, entry in entries])
+
+        # Group once the speakers are powered on and on their input
+        joins = {}
+        leaves = []
+        for entity, entry in entries:
+            result = results[entity.entity_id]
+            if ATTR_MASTER not in entry or 'error' in result:
+                continue
+            if not entry[ATTR_MASTER]:
+                if entity.group_role != 'none':
+                    leaves.append(entity)
+                continue
+            master = registry.get(entry[ATTR_MASTER])
+            if master is None:
+                result['error'] = 'unknown master'
+            elif master is not entity and \
+                    entity.ip_address not in master.zone.group_clients:
+                joins.setdefault(master, []).append(entity)
+
+        async def join(master, clients):
+            """Add the clients of a master."""
+            try:
+                failed = await master.async_join_add(clients)
+            except Exception as err:  # pylint: disable=broad-except
+                failed = {e.ip_address: repr(err) for e in clients}
+            for client in clients:
+                result = results[client.entity_id]
+                if client.ip_address in failed:
+                    result['error'] = failed[client.ip_address]
+                else:
+                    result.setdefault('sent', []).append('setClientInfo')
+
+        async def leave(entity):
+            """Remove an entity from its group."""
+            try:
+                await entity.async_unjoin()
+            except Exception as err:  # pylint: disable=broad-except
+                results[entity.entity_id]['error'] = repr(err)
+            else:
+                results[entity.entity_id]['sent'].append('unjoin')
+
+        await asyncio.gather(
+            *[join(master, clients) for master, clients in joins.items()],
+            *[leave(entity) for entity in leaves])
+
+        _LOGGER.debug("**APPLY_SNAPSHOT** results: %s", results)
+        hass.bus.async_fire(EVENT_SNAPSHOT_APPLIED, {'results': results})
+
+    def dump_metrics(service):
+        """Write the request and event metrics to a file."""
+        snapshot = METRICS.snapshot()
+        path = hass.config.path(METRICS_FILE)
+        with open(path, 'w') as metrics_file:
+            json.dump(snapshot, metrics_file, indent=2, sort_keys=True)
+        for host, endpoints in sorted(snapshot['requests'].items()):
+            slowest = max(endpoints.items(), key=lambda e: e[1]['p95_ms'])
+            _LOGGER.info(
+                "%s: %d requests, %d errors, %d timeouts, slowest %s "
+                "(p95 %.1f ms)", host,
+                sum(e['count'] for e in endpoints.values()),
+                sum(e['errors'] for e in endpoints.values()),
+                sum(e['timeouts'] for e in endpoints.values()),
+                slowest[0], slowest[1]['p95_ms'])
+        _LOGGER.info("Metrics written to %s", path)
+
+    def record_events(service):
+        """Capture the received UDP events to a file for a while."""
+        recorder = start_recording(hass.config.path(EVENTS_FILE))
+        call_later(hass, service.data[ATTR_DURATION],
+                   lambda _: stop_recording(recorder))
+
+    hass.services.register(
+        DOMAIN, SERVICE_JOIN, async_service_handle, schema=JOIN_SERVICE_SCHEMA)
+    hass.services.register(
+        DOMAIN, SERVICE_UNJOIN, async_service_handle, schema=SERVICE_SCHEMA)
     hass.services.register(
-        DOMAIN, SERVICE_JOIN, service_handle, schema=JOIN_SERVICE_SCHEMA)
+        DOMAIN, SERVICE_APPLY_SNAPSHOT, async_apply_snapshot,
+        schema=APPLY_SNAPSHOT_SCHEMA)
+    hass.services.register(DOMAIN, SERVICE_DUMP_METRICS, dump_metrics)
     hass.services.register(
-        DOMAIN, SERVICE_UNJOIN, service_handle, schema=SERVICE_SCHEMA)
+        DOMAIN, SERVICE_RECORD_EVENTS, record_events,
+        schema=RECORD_EVENTS_SCHEMA)
 
     return True
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+"""This file finds the MusicCast devices of the local network."""
+import ipaddress
+import logging
+import socket
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from urllib.parse import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+from .const import ENDPOINTS
+_LOGGER = logging.getLogger(__name__)
+
+DEFAULT_DISCOVERY_WORKERS = 64
+DEFAULT_DISCOVERY_DEADLINE = 5
+DEFAULT_HTTP_PORT = 80
+
+# Candidates not answering within this many seconds are skipped
+PROBE_TIMEOUT = 1
+# Larger subnets would take too long to probe
+MAX_SUBNET_HOSTS = 1024
+
+SSDP_ADDRESS = ('239.255.255.250', 1900)
+SSDP_SEARCH = '\r\n'.join([
+    'M-SEARCH * HTTP/1.1',
+    'HOST: 239.255.255.250:1900',
+    'MAN: "ssdp:discover"',
+    'MX: 1',
+    'ST: urn:schemas-upnp-org:device:MediaRenderer:1',
+    '', '']).encode('ascii')
+
+
+def subnet_hosts(subnet, port=DEFAULT_HTTP_PORT):
+    """Returns the host of every address of a subnet."""
+    network = ipaddress.ip_network(subnet, strict=False)
+    if network.num_addresses > MAX_SUBNET_HOSTS:
+        raise ValueError("%s has more than %d addresses" %
+                         (subnet, MAX_SUBNET_HOSTS))
+    suffix = '' if port == DEFAULT_HTTP_PORT else ':%d' % port
+    addresses = list(network.hosts()) or [network.network_address]
+    return ['%s%s' % (address, suffix) for address in addresses]
+
+
+def ssdp_hosts(timeout=DEFAULT_DISCOVERY_DEADLINE / 2):
+    """Returns the host of every media renderer answering an SSDP search."""
+    hosts = set()
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 2)
+        sock.sendto(SSDP_SEARCH, SSDP_ADDRESS)
+        deadline = time.monotonic() + timeout
+        while True:
+            sock.settimeout(max(deadline - time.monotonic(), 0.01))
+            try:
+                data, addr = sock.recvfrom(65535)
+            except socket.timeout:
+                break
+            for line in data.decode('utf-8', 'replace').splitlines():
+                name, _, value = line.partition(':')
+                if name.strip().lower() == 'location':
+                    hosts.add(urlparse(value.strip()).hostname or addr[0])
+            if time.monotonic() >= deadline:
+                break
+    return sorted(hosts)
+
+
+def probe(session, host):
+    """Returns the device and network info of a MusicCast host or None."""
+    try:
+        device_info = session.get(ENDPOINTS["getDeviceInfo"].format(host),
+                                  timeout=PROBE_TIMEOUT).json()
+        if device_info.get('response_code') != 0 or \
+           not device_info.get('device_id'):
+            return None
+        network_status = session.get(
+            ENDPOINTS["getNetworkStatus"].format(host),
+            timeout=PROBE_TIMEOUT).json()
+    except (OSError, ValueError, AttributeError,
+            requests.RequestException):
+        return None
+    return {'host': host, 'device_info': device_info,
+            'network_status': network_status}
+
+
+def discover(hosts, max_workers=DEFAULT_DISCOVERY_WORKERS,
+             deadline=DEFAULT_DISCOVERY_DEADLINE):
+    """Probe the candidate hosts concurrently until the deadline.
+
+    Returns the found devices ordered by host.
+    """
+    found = []
+    if not hosts:
+        return found
+    end = time.monotonic() + deadline
+    session = requests.Session()
+    session.mount('http://', HTTPAdapter(pool_connections=max_workers,
+                                         pool_maxsize=1))
+    executor = ThreadPoolExecutor(max_workers=min(max_workers, len(hosts)),
+                                  thread_name_prefix="Discovery")
+    try:
+        pending = {executor.submit(probe, session, host) for host in hosts}
+        while pending and time.monotonic() < end:
+            done, pending = wait(pending, timeout=end - time.monotonic(),
+                                 return_when=FIRST_COMPLETED)
+            found.extend(future.result() for future in done
+                         if future.result())
+        for future in pending:
+            future.cancel()
+        if pending:
+            _LOGGER.debug("Discovery deadline reached, %d hosts not probed",
+                          len(pending))
+    finally:
+        executor.shutdown(wait=False)
+        session.close()
+    _LOGGER.debug("Discovered %d devices among %d hosts", len(found),
+                  len(hosts))
+    return sorted(found, key=lambda device: device['host'])
@@ -1,35 +1,1432 @@
 #!/usr/bin/env python
 """This file holds helper functions."""
+import io
+import os
 import json
 import time
+import hashlib
+import queue
+import socket
+import struct
+import heapq
+import asyncio
 import logging
+import functools
+import itertools
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from urllib.parse import urlparse
+import aiohttp
 import requests
+from requests.adapters import HTTPAdapter
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
 _LOGGER = logging.getLogger(__name__)
 
+DEFAULT_POOL_SIZE = 4
+DEFAULT_POOL_IDLE_TIMEOUT = 60
+DEFAULT_COALESCE_WINDOW = 0.05
+DEFAULT_POLL_MIN_INTERVAL = 30
+DEFAULT_POLL_MAX_INTERVAL = 600
+DEFAULT_POLL_SILENCE = 120
+DEFAULT_FAN_OUT_WORKERS = 8
+DEFAULT_RATE_LIMIT = 10
+DEFAULT_EVENT_QUEUE_SIZE = 1000
+DEFAULT_DISPATCH_WORKERS = 8
+DEFAULT_DEDUP_WINDOW = 0.1
+DEFAULT_ART_CACHE_SIZE = 16 << 20
+
+# Large enough for any UDP datagram
+EVENT_BUFFER_SIZE = 65535
+EVENT_RECEIVE_BUFFER = 1 << 20
+SOCKET_TIMEOUT = 1
+
+# Event captures: a magic header, then per datagram its offset in seconds,
+# source address, source port and length followed by the raw bytes
+CAPTURE_MAGIC = b'MCEV\x01'
+CAPTURE_RECORD = struct.Struct('!d4sHH')
+
+ART_ENDPOINT = 'albumart'
+ART_THUMBNAIL_QUALITY = 85
+
+# User commands are sent before the background refreshes
+PRIORITY_COMMAND = 0
+PRIORITY_REFRESH = 1
+
+# Upper bounds in milliseconds of the request latency histogram buckets
+LATENCY_BUCKETS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+LATENCY_SAMPLES = 200
+EVENT_RATE_WINDOW = 60
+
+# Circuit breaker and adaptive timeouts of every host
+BREAKER_THRESHOLD = 3
+PROBE_MIN_DELAY = 5
+PROBE_MAX_DELAY = 120
+PROBE_ENDPOINT = 'system/getDeviceInfo'
+TIMEOUT_MIN = 3
+TIMEOUT_MAX = 10  # hass default timeout
+TIMEOUT_FACTOR = 4
+TIMEOUT_SAMPLES = 100
+TIMEOUT_MIN_SAMPLES = 10
+
+
+class HostUnavailable(requests.ConnectionError):
+    """Raised without contacting a host whose circuit is open."""
+
+
+def percentile(samples, percent):
+    """Returns a percentile of samples."""
+    samples = sorted(samples)
+    if not samples:
+        return None
+    return samples[min(len(samples) - 1, int(len(samples) * percent / 100))]
+
+
+def resolve(future, result=None, error=None):
+    """Set the outcome of a future unless it is already done."""
+    if future.done():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+
+class Metrics:
+    """Request latencies, errors, event rates and queue depths."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._requests = {}
+        self._events = {}
+        self._queues = {}
+
+    def record_request(self, host, endpoint, latency, error=None):
+        """Record a request and its outcome."""
+        with self._lock:
+            stats = self._requests.setdefault((host, endpoint), {
+                'count': 0, 'errors': 0, 'timeouts': 0, 'total_time': 0.0,
+                'buckets': [0] * (len(LATENCY_BUCKETS) + 1),
+                'samples': deque(maxlen=LATENCY_SAMPLES)})
+            stats['count'] += 1
+            stats['total_time'] += latency
+            stats['samples'].append(latency)
+            milliseconds = latency * 1000
+            bucket = next((index for index, bound
+                           in enumerate(LATENCY_BUCKETS)
+                           if milliseconds <= bound), len(LATENCY_BUCKETS))
+            stats['buckets'][bucket] += 1
+            if error == 'timeout':
+                stats['timeouts'] += 1
+            elif error:
+                stats['errors'] += 1
+
+    def record_event(self, device_id):
+        """Record an event received for a device."""
+        now = time.monotonic()
+        with self._lock:
+            stats = self._events.setdefault(device_id, {
+                'count': 0, 'recent': deque()})
+            stats['count'] += 1
+            stats['recent'].append(now)
+            while stats['recent'][0] < now - EVENT_RATE_WINDOW:
+                stats['recent'].popleft()
+
+    def _queue_stats(self, name):
+        """Returns the stats of a queue, lock held."""
+        return self._queues.setdefault(name, {
+            'depth': 0, 'max': 0, 'overflows': 0, 'duplicates': 0})
+
+    def record_queue_depth(self, name, depth):
+        """Record the depth of a message queue."""
+        with self._lock:
+            stats = self._queue_stats(name)
+            stats['depth'] = depth
+            stats['max'] = max(stats['max'], depth)
+
+    def record_drop(self, name, reason):
+        """Record a message dropped from a queue."""
+        with self._lock:
+            self._queue_stats(name)[reason] += 1
+
+    def snapshot(self):
+        """Returns all the metrics as a dict."""
+        now = time.monotonic()
+        with self._lock:
+            requests_stats = {}
+            for (host, endpoint), stats in self._requests.items():
+                requests_stats.setdefault(host, {})[endpoint] = {
+                    'count': stats['count'],
+                    'errors': stats['errors'],
+                    'timeouts': stats['timeouts'],
+                    'mean_ms': round(stats['total_time'] * 1000 /
+                                     stats['count'], 1),
+                    'p50_ms': round(percentile(
+                        stats['samples'], 50) * 1000, 1),
+                    'p95_ms': round(percentile(
+                        stats['samples'], 95) * 1000, 1),
+                    'histogram_ms': dict(zip(
+                        [str(bound) for bound in LATENCY_BUCKETS] + ['inf'],
+                        stats['buckets'])),
+                }
+            events_stats = {
+                device_id: {
+                    'count': stats['count'],
+                    'per_minute': len([stamp for stamp in stats['recent']
+                                       if stamp >= now - EVENT_RATE_WINDOW]),
+                } for device_id, stats in self._events.items()}
+            queues_stats = {name: dict(stats)
+                            for name, stats in self._queues.items()}
+        return {'requests': requests_stats, 'events': events_stats,
+                'queues': queues_stats}
+
+
+METRICS = Metrics()
+
+
+def endpoint_name(url):
+    """Returns the endpoint of a YamahaExtendedControl url."""
+    return urlparse(url).path.split('/v1/', 1)[-1]
+
+
+class HostHealth:
+    """Circuit breaker and adaptive timeout of a single speaker."""
+
+    def __init__(self, host):
+        self.host = host
+        self.failures = 0
+        self.opened_at = None
+        self.latencies = deque(maxlen=TIMEOUT_SAMPLES)
+        self._callbacks = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    @property
+    def available(self):
+        """Returns true if requests are sent to the host."""
+        return self.opened_at is None
+
+    @property
+    def timeout(self):
+        """Returns a timeout derived from the observed latencies."""
+        if len(self.latencies) < TIMEOUT_MIN_SAMPLES:
+            return TIMEOUT_MAX
+        return min(max(percentile(self.latencies, 99) * TIMEOUT_FACTOR,
+                       TIMEOUT_MIN), TIMEOUT_MAX)
+
+    def subscribe(self, callback):
+        """Call callback when the host recovers."""
+        self._callbacks.append(callback)
+
+    def check(self):
+        """Fail fast while the circuit is open."""
+        if self.opened_at is not None:
+            raise HostUnavailable("%s: Circuit open since %d failures" %
+                                  (self.host, self.failures))
+
+    def succeeded(self, latency):
+        """Record a request answered by the host."""
+        self.latencies.append(latency)
+        self.failures = 0
+
+    def failed(self):
+        """Record a request the host did not answer, opening the circuit."""
+        with self._lock:
+            self.failures += 1
+            if self.failures < BREAKER_THRESHOLD or \
+                    self.opened_at is not None:
+                return
+            self.opened_at = time.monotonic()
+        _LOGGER.warning("%s: %d requests failed, pausing requests until "
+                        "the device answers again", self.host, self.failures)
+        probe_thread = threading.Thread(
+            name="ProbeThread-%s" % self.host, target=self.probe)
+        probe_thread.daemon = True
+        probe_thread.start()
+
+    def probe(self):
+        """Check the host in the background until it answers."""
+        url = 'http://%s/YamahaExtendedControl/v1/%s' % (self.host,
+                                                         PROBE_ENDPOINT)
+        delay = PROBE_MIN_DELAY
+        while not self._stop.wait(delay):
+            try:
+                get_session(self.host).get(url, timeout=TIMEOUT_MAX).json()
+                break
+            except (OSError, ValueError, requests.RequestException) as err:
+                _LOGGER.debug("%s: Probe failed: %s", self.host, err)
+                delay = min(delay * 2, PROBE_MAX_DELAY)
+        else:
+            return
+        _LOGGER.info("%s: Device answers again after %d seconds", self.host,
+                     time.monotonic() - self.opened_at)
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+        for callback in self._callbacks:
+            callback()
+
+    def close(self):
+        """Stop probing the host."""
+        self._stop.set()
+
+
+_HEALTH = {}
+_HEALTH_LOCK = threading.Lock()
+
+
+def get_health(host):
+    """Return the health of a host."""
+    with _HEALTH_LOCK:
+        if host not in _HEALTH:
+            _HEALTH[host] = HostHealth(host)
+        return _HEALTH[host]
+
+
+class RequestScheduler:
+    """Send one request at a time to a speaker, user commands first.
+
+    Reads waiting in the queue with the same arguments share one request.
+    """
+
+    def __init__(self, host, rate_limit=DEFAULT_RATE_LIMIT):
+        self.host = host
+        self.interval = 1 / rate_limit if rate_limit else 0
+        self._lock = threading.Lock()
+        self._queue = []
+        self._order = itertools.count()
+        self._reads = {}
+        self._busy = False
+        self._next_start = 0
+        self._timer = None
+
+    def queue_read(self, key):
+        """Returns the future of a queued read and true if it is new."""
+        with self._lock:
+            if key in self._reads:
+                return self._reads[key], False
+            self._reads[key] = Future()
+            return self._reads[key], True
+
+    def forget_read(self, key, future):
+        """Stop merging reads into a future that will not be sent."""
+        with self._lock:
+            if self._reads.get(key) is future:
+                del self._reads[key]
+
+    def acquire(self, priority, read_key=None):
+        """Returns a future set when the caller may send its request."""
+        future = Future()
+        with self._lock:
+            heapq.heappush(self._queue,
+                           (priority, next(self._order), future, read_key))
+            if not self._busy:
+                self._grant()
+        METRICS.record_queue_depth(self.host, len(self._queue))
+        return future
+
+    def release(self):
+        """Let the next request go."""
+        with self._lock:
+            self._grant()
+
+    def _grant(self):
+        """Give the slot to the first waiting request, lock held."""
+        self._busy = False
+        while self._queue:
+            priority, _, future, read_key = self._queue[0]
+            now = time.monotonic()
+            # Only the background reads are spaced by the rate limit, the
+            # slot stays free for commands until the next read may go
+            if priority != PRIORITY_COMMAND and now < self._next_start:
+                if self._timer is None:
+                    self._timer = threading.Timer(self._next_start - now,
+                                                  self._wake)
+                    self._timer.daemon = True
+                    self._timer.start()
+                return
+            heapq.heappop(self._queue)
+            if future.set_running_or_notify_cancel():
+                self._reads.pop(read_key, None)
+                if priority != PRIORITY_COMMAND:
+                    self._next_start = now + self.interval
+                self._busy = True
+                future.set_result(now)
+                return
+
+    def _wake(self):
+        """Grant the slot to a read that waited for the rate limit."""
+        with self._lock:
+            self._timer = None
+            if not self._busy:
+                self._grant()
+
+
+_SCHEDULERS = {}
+_SCHEDULERS_LOCK = threading.Lock()
+
+
+def configure_scheduler(host, rate_limit=DEFAULT_RATE_LIMIT):
+    """Set the maximum number of requests per second to a host."""
+    with _SCHEDULERS_LOCK:
+        _SCHEDULERS[host] = RequestScheduler(host, rate_limit)
+
+
+def get_scheduler(host):
+    """Return the request scheduler of a host."""
+    with _SCHEDULERS_LOCK:
+        if host not in _SCHEDULERS:
+            _SCHEDULERS[host] = RequestScheduler(host)
+        return _SCHEDULERS[host]
+
+
+def request_priority(method, endpoint, *args, **kwargs):
+    """Returns the priority of a request and the key merging it if a read."""
+    if not endpoint.rsplit('/', 1)[-1].startswith('get'):
+        return PRIORITY_COMMAND, None
+    return PRIORITY_REFRESH, (method, endpoint, repr(args),
+                              repr(sorted(kwargs.items())))
+
+
+class HostPool:
+    """Keep-alive HTTP session for a single speaker."""
+
+    def __init__(self, host, pool_size=DEFAULT_POOL_SIZE,
+                 idle_timeout=DEFAULT_POOL_IDLE_TIMEOUT):
+        self.host = host
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self.last_used = time.monotonic()
+        self._session = None
+        self._async_session = None
+
+    @property
+    def session(self):
+        """Returns the session, opening it if needed."""
+        if self._session is None:
+            _LOGGER.debug("%s: Opening HTTP session (pool size %d)",
+                          self.host, self.pool_size)
+            adapter = HTTPAdapter(pool_connections=1,
+                                  pool_maxsize=self.pool_size)
+            self._session = requests.Session()
+            self._session.mount('http://', adapter)
+        self.last_used = time.monotonic()
+        return self._session
+
+    @property
+    def async_session(self):
+        """Returns the aiohttp session, opening it if needed."""
+        if self._async_session is None or self._async_session.closed:
+            _LOGGER.debug("%s: Opening async HTTP session (pool size %d)",
+                          self.host, self.pool_size)
+            connector = aiohttp.TCPConnector(
+                limit=self.pool_size, keepalive_timeout=self.idle_timeout)
+            self._async_session = aiohttp.ClientSession(connector=connector)
+        self.last_used = time.monotonic()
+        return self._async_session
+
+    def is_idle(self, now):
+        """Returns true if the session has not been used for a while."""
+        return (self._session is not None and
+                now - self.last_used > self.idle_timeout)
+
+    def close(self):
+        """Close all the connections of the session."""
+        if self._session is not None:
+            _LOGGER.debug("%s: Closing HTTP session", self.host)
+            self._session.close()
+            self._session = None
+
+    async def async_close(self):
+        """Close all the connections of the aiohttp session."""
+        if self._async_session is not None:
+            _LOGGER.debug("%s: Closing async HTTP session", self.host)
+            await self._async_session.close()
+            self._async_session = None
+
+
+_POOLS = {}
+_POOLS_LOCK = threading.Lock()
+
+
+def configure_pool(host, pool_size=DEFAULT_POOL_SIZE,
+                   idle_timeout=DEFAULT_POOL_IDLE_TIMEOUT):
+    """Set the connection pool options for a host."""
+    with _POOLS_LOCK:
+        pool = _POOLS.pop(host, None)
+        if pool:
+            pool.close()
+        _POOLS[host] = HostPool(host, pool_size, idle_timeout)
+
+
+def get_session(host):
+    """Return the keep-alive session of a host, evicting idle ones."""
+    now = time.monotonic()
+    with _POOLS_LOCK:
+        for pool in _POOLS.values():
+            if pool.is_idle(now):
+                pool.close()
+        if host not in _POOLS:
+            _POOLS[host] = HostPool(host)
+        return _POOLS[host].session
+
+
+def get_async_session(host):
+    """Return the aiohttp session of a host."""
+    with _POOLS_LOCK:
+        if host not in _POOLS:
+            _POOLS[host] = HostPool(host)
+        return _POOLS[host].async_session
+
+
+def close_sessions(*_):
+    """Close the connections of every host."""
+    with _HEALTH_LOCK:
+        for health in _HEALTH.values():
+            health.close()
+    with _POOLS_LOCK:
+        for pool in _POOLS.values():
+            pool.close()
+
+
+async def async_close_sessions(*_):
+    """Close the aiohttp connections of every host."""
+    with _POOLS_LOCK:
+        pools = list(_POOLS.values())
+    await asyncio.gather(*[pool.async_close() for pool in pools])
+
 
 def request(url, *args, **kwargs):
     """Do the HTTP Request and return data"""
     method = kwargs.pop('method', 'GET')
-    timeout = kwargs.pop('timeout', 10)  # hass default timeout
-    req = requests.request(method, url, *args, timeout=timeout, **kwargs)
-    data = req.json()
     urlparsed = urlparse(url)
     ip_addrress = urlparsed.netloc
-    _LOGGER.debug("%s: %s", json.dumps(data), ip_addrress)
+    health = get_health(ip_addrress)
+    health.check()
+    timeout = kwargs.pop('timeout', health.timeout)
+    scheduler = get_scheduler(ip_addrress)
+    endpoint = endpoint_name(url)
+    priority, read_key = request_priority(method, endpoint, *args, **kwargs)
+    read = None
+    if read_key:
+        read, new = scheduler.queue_read(read_key)
+        if not new:
+            return read.result()
+    try:
+        scheduler.acquire(priority, read_key).result()
+        try:
+            data = _send(health, endpoint, method, url, args, timeout,
+                         kwargs)
+        finally:
+            scheduler.release()
+    except Exception as err:
+        if read:
+            scheduler.forget_read(read_key, read)
+            resolve(read, error=err)
+        raise
+    if read:
+        resolve(read, data)
     return data
 
 
-def message_worker(device):
-    """Loop through messages and pass them on to right device"""
+def _send(health, endpoint, method, url, args, timeout, kwargs):
+    """Send a scheduled request and record how it went."""
+    session = get_session(health.host)
+    start = time.monotonic()
+    error = None
+    try:
+        req = session.request(method, url, *args, timeout=timeout, **kwargs)
+        health.succeeded(time.monotonic() - start)
+        data = req.json()
+    except requests.Timeout:
+        error = 'timeout'
+        health.failed()
+        raise
+    except ValueError:
+        error = 'error'
+        raise
+    except (OSError, requests.RequestException):
+        error = 'error'
+        health.failed()
+        raise
+    finally:
+        METRICS.record_request(health.host, endpoint,
+                               time.monotonic() - start, error)
+    _LOGGER.debug("%s: %s", json.dumps(data), health.host)
+    return data
+
+
+async def async_request(url, *args, **kwargs):
+    """Do the HTTP Request on the event loop and return data
+
+    With raw=True the body and content type are returned instead.
+    """
+    method = kwargs.pop('method', 'GET')
+    raw = kwargs.pop('raw', False)
+    urlparsed = urlparse(url)
+    ip_addrress = urlparsed.netloc
+    health = get_health(ip_addrress)
+    health.check()
+    timeout = kwargs.pop('timeout', health.timeout)
+    scheduler = get_scheduler(ip_addrress)
+    if raw:
+        endpoint = ART_ENDPOINT
+        priority, read_key = PRIORITY_REFRESH, None
+    else:
+        endpoint = endpoint_name(url)
+        priority, read_key = request_priority(method, endpoint, *args,
+                                              **kwargs)
+    send = functools.partial(_async_schedule, scheduler, priority, read_key,
+                             health, endpoint, method, url, args, timeout,
+                             kwargs, raw)
+    if not read_key:
+        return await send()
+    read, new = scheduler.queue_read(read_key)
+    if new:
+        # Sent from a task of its own so that a cancelled caller does not
+        # cancel the read of the callers merged into it
+        task = asyncio.ensure_future(_async_read(scheduler, read_key, read,
+                                                 send))
+        _READ_TASKS.add(task)
+        task.add_done_callback(_READ_TASKS.discard)
+    return await asyncio.shield(asyncio.wrap_future(read))
+
+
+_READ_TASKS = set()
+
+
+async def _async_read(scheduler, read_key, read, send):
+    """Send a read and pass its outcome to every caller merged into it."""
+    try:
+        data = await send()
+    except Exception as err:
+        scheduler.forget_read(read_key, read)
+        resolve(read, error=err)
+    except asyncio.CancelledError:
+        scheduler.forget_read(read_key, read)
+        resolve(read, error=requests.ConnectionError(
+            "Read of %s cancelled" % read_key[1]))
+        raise
+    else:
+        resolve(read, data)
+
+
+async def _async_schedule(scheduler, priority, read_key, health, endpoint,
+                          method, url, args, timeout, kwargs, raw):
+    """Wait for the turn of a request and send it."""
+    slot = scheduler.acquire(priority, read_key)
+    try:
+        await asyncio.wrap_future(slot)
+    except asyncio.CancelledError:
+        if not slot.cancel():
+            scheduler.release()
+        raise
+    try:
+        return await _async_send(health, endpoint, method, url, args,
+                                 timeout, kwargs, raw)
+    finally:
+        scheduler.release()
+
+
+async def _async_send(health, endpoint, method, url, args, timeout, kwargs,
+                      raw=False):
+    """Send a scheduled request on the event loop and record how it went."""
+    session = get_async_session(health.host)
+    start = time.monotonic()
+    error = None
+    try:
+        async with session.request(
+                method, url, *args,
+                timeout=aiohttp.ClientTimeout(total=timeout),
+                **kwargs) as req:
+            health.succeeded(time.monotonic() - start)
+            if raw:
+                req.raise_for_status()
+                return await req.read(), req.content_type
+            data = await req.json(content_type=None)
+    except asyncio.TimeoutError:
+        error = 'timeout'
+        health.failed()
+        raise
+    except ValueError:
+        error = 'error'
+        raise
+    except (OSError, aiohttp.ClientError):
+        error = 'error'
+        health.failed()
+        raise
+    finally:
+        METRICS.record_request(health.host, endpoint,
+                               time.monotonic() - start, error)
+    _LOGGER.debug("%s: %s", json.dumps(data), health.host)
+    return data
+
+
+def request_failure(response):
+    """Returns the reason a request failed or None on success."""
+    if isinstance(response, Exception):
+        return repr(response)
+    if not isinstance(response, dict):
+        return "invalid response: %r" % (response,)
+    if response.get('response_code', 0) != 0:
+        return "response_code %s" % response.get('response_code')
+    return None
+
+
+def fan_out(func, items, max_workers=DEFAULT_FAN_OUT_WORKERS,
+            check=request_failure):
+    """Call func for every item concurrently.
+
+    Returns a dict of the failed items and the reason of the failure
+    given by check.
+    """
+    if not items:
+        return {}
+
+    def call(item):
+        try:
+            return func(item)
+        except (OSError, ValueError, requests.RequestException) as err:
+            return err
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items)),
+                            thread_name_prefix="FanOut") as executor:
+        responses = list(executor.map(call, items))
+    failures = {item: check(response)
+                for item, response in zip(items, responses)}
+    return {item: reason for item, reason in failures.items() if reason}
+
+
+async def async_fan_out(func, items, max_workers=DEFAULT_FAN_OUT_WORKERS,
+                        check=request_failure):
+    """Await func for every item concurrently.
+
+    Returns a dict of the failed items and the reason of the failure
+    given by check.
+    """
+    semaphore = asyncio.Semaphore(max_workers)
+
+    async def call(item):
+        async with semaphore:
+            try:
+                return await func(item)
+            except (OSError, ValueError, asyncio.TimeoutError,
+                    aiohttp.ClientError) as err:
+                return err
+
+    responses = await asyncio.gather(*[call(item) for item in items])
+    failures = {item: check(response)
+                for item, response in zip(items, responses)}
+    return {item: reason for item, reason in failures.items() if reason}
+
+
+class MetadataStore:
+    """Static device metadata persisted between restarts.
+
+    save is called after every change, it must not block.
+    """
+
+    def __init__(self, data=None, save=None):
+        self._lock = threading.Lock()
+        self._data = dict(data or {})
+        self._save = save
+
+    def get(self, key):
+        """Returns the metadata stored for key."""
+        with self._lock:
+            return self._data.get(key)
+
+    def set(self, key, metadata):
+        """Store the metadata of key, saving it only if it changed."""
+        with self._lock:
+            if self._data.get(key) == metadata:
+                return
+            self._data[key] = metadata
+        if self._save:
+            self._save()
+
+    def data(self):
+        """Returns a copy of the metadata of every key."""
+        with self._lock:
+            return dict(self._data)
+
+
+def album_art_key(url, *track):
+    """Returns the cache key of the album art of a track."""
+    return hashlib.sha256(
+        repr((url,) + track).encode('utf-8')).hexdigest()[:16]
+
+
+class AlbumArtCache:
+    """LRU cache of album art in memory and optionally on disk.
+
+    Concurrent requests of the same image share one fetch.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_ART_CACHE_SIZE, path=None,
+                 thumbnail_size=None):
+        self.max_bytes = max_bytes
+        self.path = path
+        self.thumbnail_size = thumbnail_size
+        if thumbnail_size and Image is None:
+            _LOGGER.warning("Pillow is not installed, album art will not "
+                            "be downscaled")
+            self.thumbnail_size = None
+        self._images = OrderedDict()
+        self._size = 0
+        self._files = OrderedDict()
+        self._files_size = 0
+        self._in_flight = {}
+        if path:
+            self._scan()
+
+    def _scan(self):
+        """Index the images stored on disk, oldest first."""
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            entries = sorted(os.scandir(self.path),
+                             key=lambda entry: entry.stat().st_mtime)
+        except OSError as err:
+            _LOGGER.warning("Not caching album art in %s: %s", self.path, err)
+            self.path = None
+            return
+        for entry in entries:
+            key, _, subtype = entry.name.partition('.')
+            self._files[key] = (subtype, entry.stat().st_size)
+            self._files_size += entry.stat().st_size
+
+    def _remember(self, key, image):
+        """Keep an image in memory, forgetting the least recently used."""
+        self._images[key] = image
+        self._size += len(image[0])
+        while self._size > self.max_bytes:
+            _, (content, _) = self._images.popitem(last=False)
+            self._size -= len(content)
+
+    def _read(self, key):
+        """Returns an image stored on disk or None."""
+        subtype, _ = self._files[key]
+        filename = os.path.join(self.path, '%s.%s' % (key, subtype))
+        try:
+            with open(filename, 'rb') as fdesc:
+                content = fdesc.read()
+            os.utime(filename)
+        except OSError:
+            return None
+        return content, 'image/%s' % subtype
+
+    def _write(self, key, image):
+        """Store an image on disk, removing the least recently used."""
+        subtype = image[1].partition('/')[2] or 'jpeg'
+        filename = os.path.join(self.path, '%s.%s' % (key, subtype))
+        try:
+            with open(filename, 'wb') as fdesc:
+                fdesc.write(image[0])
+        except OSError as err:
+            _LOGGER.warning("Could not store album art in %s: %s",
+                            self.path, err)
+            return
+        self._files[key] = (subtype, len(image[0]))
+        self._files_size += len(image[0])
+        while self._files_size > self.max_bytes:
+            evicted, (evicted_subtype, size) = self._files.popitem(last=False)
+            self._files_size -= size
+            try:
+                os.remove(os.path.join(self.path, '%s.%s' % (
+                    evicted, evicted_subtype)))
+            except OSError as err:
+                _LOGGER.debug("Could not remove album art: %s", err)
+
+    def _thumbnail(self, image):
+        """Returns the image downscaled to the thumbnail size."""
+        try:
+            with Image.open(io.BytesIO(image[0])) as picture:
+                picture.thumbnail((self.thumbnail_size, self.thumbnail_size))
+                output = io.BytesIO()
+                picture.convert('RGB').save(output, 'JPEG',
+                                            quality=ART_THUMBNAIL_QUALITY)
+        except (OSError, ValueError) as err:
+            _LOGGER.debug("Could not downscale album art: %s", err)
+            return image
+        return output.getvalue(), 'image/jpeg'
+
+    async def async_get(self, key, url):
+        """Returns the (content, content type) of key, fetching url."""
+        if key in self._images:
+            self._images.move_to_end(key)
+            return self._images[key]
+        if key not in self._in_flight:
+            # Fetched from a task of its own so that a viewer going away
+            # does not cancel the fetch shared by the others
+            self._in_flight[key] = asyncio.ensure_future(
+                self._async_fetch(key, url))
+        return await asyncio.shield(self._in_flight[key])
+
+    async def _async_fetch(self, key, url):
+        """Load an image and keep it in memory."""
+        try:
+            image = await self._async_load(key, url,
+                                           asyncio.get_event_loop())
+        except Exception:  # pylint: disable=broad-except
+            _LOGGER.error("Could not load album art %s", url, exc_info=True)
+            return None, None
+        finally:
+            del self._in_flight[key]
+        if image[0] is not None:
+            self._remember(key, image)
+        return image
+
+    async def _async_load(self, key, url, loop):
+        """Read an image from disk or fetch it from the device."""
+        if self.path and key in self._files:
+            self._files.move_to_end(key)
+            image = await loop.run_in_executor(None, self._read, key)
+            if image:
+                return image
+        try:
+            image = await async_request(url, raw=True)
+        except (OSError, asyncio.TimeoutError, aiohttp.ClientError) as err:
+            _LOGGER.debug("Could not fetch album art %s: %s", url, err)
+            return None, None
+        if self.thumbnail_size:
+            image = await loop.run_in_executor(None, self._thumbnail, image)
+        if self.path:
+            await loop.run_in_executor(None, self._write, key, image)
+        return image
+
+
+class SingleFlightCache:
+    """TTL cache where concurrent loads of the same key share one call."""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._in_flight = {}
+        self._tasks = set()
+
+    def _lookup(self, key):
+        """Returns the cached value or the future of its load.
+
+        The last item is true if the caller must load the key itself.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and time.monotonic() - entry[0] < self.ttl:
+                return entry[1], None, False
+            if key in self._in_flight:
+                return None, self._in_flight[key], False
+            future = self._in_flight[key] = Future()
+            return None, future, True
+
+    def _loaded(self, key, future, value=None, error=None):
+        """Store the loaded value and wake up the waiting callers.
+
+        A load detached by invalidate does not store its value.
+        """
+        with self._lock:
+            if self._in_flight.get(key) is future:
+                del self._in_flight[key]
+                if error is None:
+                    self._entries[key] = (time.monotonic(), value)
+        resolve(future, value, error)
+
+    def get(self, key, loader):
+        """Returns the cached value of key, calling loader if needed."""
+        value, future, owner = self._lookup(key)
+        if future is None:
+            return value
+        if not owner:
+            return future.result()
+        try:
+            value = loader()
+        except BaseException as err:
+            self._loaded(key, future, error=err)
+            raise
+        self._loaded(key, future, value)
+        return value
+
+    async def async_get(self, key, loader):
+        """Returns the cached value of key, awaiting loader if needed."""
+        value, future, owner = self._lookup(key)
+        if future is None:
+            return value
+        if owner:
+            # Loaded from a task of its own so that a cancelled caller does
+            # not cancel the load shared by the others
+            task = asyncio.ensure_future(self._async_load(key, future,
+                                                          loader))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        return await asyncio.shield(asyncio.wrap_future(future))
+
+    async def _async_load(self, key, future, loader):
+        """Await loader and pass its outcome to every waiting caller."""
+        try:
+            value = await loader()
+        except asyncio.CancelledError:
+            self._loaded(key, future, error=requests.ConnectionError(
+                "Load of %s cancelled" % (key,)))
+            raise
+        except Exception as err:
+            self._loaded(key, future, error=err)
+        else:
+            self._loaded(key, future, value)
+
+    def invalidate(self, key):
+        """Forget the value of key and detach its load in flight.
+
+        Callers after invalidate start a fresh load instead of joining one
+        that may have started before the change.
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+            self._in_flight.pop(key, None)
+
+
+class CommandCoalescer:
+    """Send only the latest value of idempotent commands.
+
+    While a command is in flight, newer values of the same command wait in
+    a single slot, each one replacing the previous one. Superseded callers
+    get the result of the value that replaced theirs.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._in_flight = set()
+        self._tasks = set()
+
+    def _queue(self, key, send):
+        """Returns the future of send and true if the caller must send."""
+        with self._lock:
+            if key in self._pending:
+                _LOGGER.debug("%s: Dropping superseded %s", self.name, key)
+                future = self._pending[key][1]
+            else:
+                future = Future()
+            self._pending[key] = (send, future)
+            if key in self._in_flight:
+                return future, False
+            self._in_flight.add(key)
+            return future, True
+
+    def _next(self, key):
+        """Returns the latest pending command of key or None when done."""
+        with self._lock:
+            entry = self._pending.pop(key, None)
+            if entry is None:
+                self._in_flight.discard(key)
+            return entry
+
+    def _abort(self, key):
+        """Cancel the pending command of key."""
+        with self._lock:
+            entry = self._pending.pop(key, None)
+            self._in_flight.discard(key)
+        if entry:
+            entry[1].cancel()
+
+    def submit(self, key, send):
+        """Call send unless a newer value of key replaces it."""
+        future, sender = self._queue(key, send)
+        if sender:
+            entry = self._next(key)
+            try:
+                while entry:
+                    send, pending = entry
+                    try:
+                        resolve(pending, send())
+                    except Exception as err:
+                        resolve(pending, error=err)
+                    entry = self._next(key)
+            finally:
+                if entry:
+                    entry[1].cancel()
+                    self._abort(key)
+        return future.result()
+
+    async def async_submit(self, key, send):
+        """Await send() unless a newer value of key replaces it."""
+        key = (key, 'async')
+        future, sender = self._queue(key, send)
+        if sender:
+            # Sent from a task of its own so that a cancelled caller does
+            # not stop the values queued behind its own
+            task = asyncio.ensure_future(self._async_send_pending(key))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        # A cancelled caller must not cancel the future it shares
+        return await asyncio.shield(asyncio.wrap_future(future))
+
+    async def _async_send_pending(self, key):
+        """Send the latest value of key until no newer one is waiting."""
+        entry = self._next(key)
+        try:
+            while entry:
+                send, pending = entry
+                try:
+                    resolve(pending, await send())
+                except Exception as err:
+                    resolve(pending, error=err)
+                entry = self._next(key)
+        finally:
+            # Only left early when the event loop stops
+            if entry:
+                entry[1].cancel()
+                self._abort(key)
+
+
+class PollScheduler:
+    """Decide when a zone must be polled although it pushes events."""
+
+    def __init__(self, min_interval=DEFAULT_POLL_MIN_INTERVAL,
+                 max_interval=DEFAULT_POLL_MAX_INTERVAL,
+                 silence=DEFAULT_POLL_SILENCE):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.silence = silence
+        self.interval = min_interval
+        self.last_event = None
+        self.last_poll = None
+
+    def event_received(self):
+        """Events are flowing, the zone is changing state."""
+        self.last_event = time.monotonic()
+        self.interval = self.min_interval
+
+    def reset(self):
+        """Poll as soon as possible."""
+        self.interval = self.min_interval
+        self.last_poll = None
+
+    def polled(self, changed, active):
+        """Speed up while the zone changes, back off while it is idle."""
+        self.last_poll = time.monotonic()
+        if changed:
+            self.interval = self.min_interval
+        elif not active:
+            self.interval = min(self.interval * 2, self.max_interval)
+        else:
+            self.interval = min(self.interval * 1.5, self.max_interval)
+
+    @property
+    def due(self):
+        """Returns true if the zone has been silent for too long."""
+        if self.last_poll is None:
+            return True
+        now = time.monotonic()
+        if self.last_event and now - self.last_event < self.silence:
+            return False
+        return now - self.last_poll >= self.interval
+
+
+class EventListener:
+    """Shared UDP socket receiving the events of every device on a port.
+
+    The events are handled on a bounded pool, one at a time per device, so
+    that the HTTP follow-ups of a slow speaker do not hold up the others.
+    """
+
+    def __init__(self, port, coalesce_window=DEFAULT_COALESCE_WINDOW,
+                 queue_size=DEFAULT_EVENT_QUEUE_SIZE,
+                 dedup_window=DEFAULT_DEDUP_WINDOW,
+                 dispatch_workers=DEFAULT_DISPATCH_WORKERS):
+        self.port = port
+        self.name = 'port %d' % port
+        self.coalesce_window = coalesce_window
+        self.dedup_window = dedup_window
+        self.messages = queue.Queue(queue_size)
+        self._devices = {}
+        self._last = {}
+        self._overflowing = False
+        self._lock = threading.Lock()
+        self._socket = None
+        self.recorder = None
+        self._pending = {}
+        self._dispatching = set()
+        self._executor = ThreadPoolExecutor(
+            max_workers=dispatch_workers,
+            thread_name_prefix="EventDispatch-%d" % port)
+
+    def start(self):
+        """Open the socket and start the socket and worker threads."""
+        _LOGGER.debug("Trying to open socket on port %d.", self.port)
+        self._socket = socket.socket(
+            socket.AF_INET,     # IPv4
+            socket.SOCK_DGRAM   # UDP
+        )
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                                EVENT_RECEIVE_BUFFER)
+        self._socket.settimeout(SOCKET_TIMEOUT)
+        self._socket.bind(('', self.port))
+        _LOGGER.debug("Socket open.")
+        socket_thread = threading.Thread(
+            name="SocketThread-%d" % self.port, target=socket_worker,
+            args=(self, self._socket,))
+        socket_thread.daemon = True
+        socket_thread.start()
+        worker_thread = threading.Thread(
+            name="WorkerThread-%d" % self.port, target=message_worker,
+            args=(self,))
+        worker_thread.daemon = True
+        worker_thread.start()
+
+    def duplicate(self, data, addr):
+        """Returns true if the datagram repeats the last one of its source.
+
+        Only an immediate repeat within the window is a duplicate, a value
+        coming back after another one is a real change.
+        """
+        now = time.monotonic()
+        last = self._last.get(addr[0])
+        self._last[addr[0]] = (data, now)
+        return last is not None and last[0] == data and \
+            now - last[1] <= self.dedup_window
+
+    def receive(self, data, addr):
+        """Record, deduplicate and queue a received datagram."""
+        recorder = self.recorder
+        if recorder:
+            recorder.record(data, addr)
+        if self.duplicate(data, addr):
+            METRICS.record_drop(self.name, 'duplicates')
+            return
+        self.enqueue(data)
+
+    def enqueue(self, message):
+        """Queue a message, dropping the oldest one when full."""
+        overflow = False
+        while True:
+            try:
+                self.messages.put_nowait(message)
+                break
+            except queue.Full:
+                try:
+                    self.messages.get_nowait()
+                    self.messages.task_done()
+                except queue.Empty:
+                    continue
+                overflow = True
+                METRICS.record_drop(self.name, 'overflows')
+        if overflow and not self._overflowing:
+            _LOGGER.warning("Event queue on port %d is full, dropping the "
+                            "oldest events", self.port)
+        self._overflowing = overflow
+        METRICS.record_queue_depth(self.name, self.messages.qsize())
+
+    def register(self, device):
+        """Route the events of a device to it."""
+        _LOGGER.debug("%s: Listening for device %s on port %d",
+                      device.ip_address, device.device_id, self.port)
+        with self._lock:
+            self._devices[device.device_id] = device
+
+    def unregister(self, device):
+        """Stop routing the events of a device."""
+        with self._lock:
+            self._devices.pop(device.device_id, None)
+
+    def get_device(self, device_id):
+        """Returns the device registered for a device_id."""
+        with self._lock:
+            return self._devices.get(device_id)
+
+    def dispatch(self, device_id, data):
+        """Hand an event to the pool, merging it into a waiting one."""
+        with self._lock:
+            if device_id not in self._devices:
+                _LOGGER.warning("Received message for unknown device: %s",
+                                device_id)
+                return
+            if device_id in self._pending:
+                merge_event(self._pending[device_id], data)
+                return
+            self._pending[device_id] = data
+            if device_id in self._dispatching:
+                return
+            self._dispatching.add(device_id)
+        try:
+            self._executor.submit(self._handle, device_id)
+        except RuntimeError:
+            _LOGGER.debug("Dispatch on port %d stopped, dropping event of "
+                          "%s", self.port, device_id)
+
+    def _handle(self, device_id):
+        """Handle the events of a device until none is waiting."""
+        done = False
+        try:
+            while True:
+                with self._lock:
+                    data = self._pending.pop(device_id, None)
+                    device = self._devices.get(device_id)
+                    if data is None or device is None:
+                        self._dispatching.discard(device_id)
+                        done = True
+                        return
+                try:
+                    device.handle_event(data)
+                except (OSError, ValueError,
+                        requests.RequestException) as err:
+                    _LOGGER.warning("%s: Could not handle event: %s",
+                                    device.ip_address, err)
+                except Exception:  # pylint: disable=broad-except
+                    _LOGGER.error("%s: Error handling event %s",
+                                  device.ip_address, data, exc_info=True)
+        finally:
+            # Let the next event of the device be dispatched again
+            if not done:
+                with self._lock:
+                    self._pending.pop(device_id, None)
+                    self._dispatching.discard(device_id)
+
+    def stop_dispatch(self, wait=False):
+        """Stop handling new events, waiting for the running ones if wait."""
+        self._executor.shutdown(wait=wait)
+
+    def close(self):
+        """Close the socket."""
+        if self._socket:
+            _LOGGER.debug("Closing Socket on port %d.", self.port)
+            self._socket.close()
+            self._socket = None
+            self.enqueue(None)
+
+
+class EventRecorder:
+    """Append the received datagrams to a capture file."""
+
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        self._start = time.monotonic()
+        self._lock = threading.Lock()
+        self._file = open(path, 'wb')
+        self._file.write(CAPTURE_MAGIC)
+
+    def record(self, data, addr):
+        """Append a datagram with its arrival time and source."""
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.write(CAPTURE_RECORD.pack(
+                time.monotonic() - self._start, socket.inet_aton(addr[0]),
+                addr[1], len(data)))
+            self._file.write(data)
+            self.count += 1
+
+    def close(self):
+        """Flush and close the capture file."""
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def read_capture(path):
+    """Yield the offset, source address and data of every datagram."""
+    with open(path, 'rb') as capture:
+        if capture.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise ValueError("%s is not an event capture" % path)
+        while True:
+            header = capture.read(CAPTURE_RECORD.size)
+            if len(header) < CAPTURE_RECORD.size:
+                return
+            offset, address, port, length = CAPTURE_RECORD.unpack(header)
+            data = capture.read(length)
+            if len(data) < length:
+                _LOGGER.warning("%s: Truncated datagram at %.3f s", path,
+                                offset)
+                return
+            yield offset, (socket.inet_ntoa(address), port), data
+
+
+_LISTENERS = {}
+_LISTENERS_LOCK = threading.Lock()
+_RECORDER = None
+
+
+def get_listener(port, coalesce_window=DEFAULT_COALESCE_WINDOW):
+    """Return the event listener of a port, starting it if needed."""
+    with _LISTENERS_LOCK:
+        if port not in _LISTENERS:
+            listener = EventListener(port, coalesce_window)
+            listener.recorder = _RECORDER
+            listener.start()
+            _LISTENERS[port] = listener
+        return _LISTENERS[port]
+
+
+def close_listeners(*_):
+    """Close the sockets of every event listener."""
+    with _LISTENERS_LOCK:
+        for listener in _LISTENERS.values():
+            listener.close()
+        _LISTENERS.clear()
+    stop_recording()
+
+
+def start_recording(path):
+    """Record the datagrams of every event listener to a capture file."""
+    global _RECORDER  # pylint: disable=global-statement
+    stop_recording()
+    with _LISTENERS_LOCK:
+        _RECORDER = EventRecorder(path)
+        for listener in _LISTENERS.values():
+            listener.recorder = _RECORDER
+    _LOGGER.info("Recording events to %s", path)
+    return _RECORDER
+
+
+def stop_recording(recorder=None):
+    """Stop recording, returning the number of recorded datagrams.
+
+    Given a recorder, stop only if it was not replaced by a newer one.
+    """
+    global _RECORDER  # pylint: disable=global-statement
+    with _LISTENERS_LOCK:
+        if recorder is not None and recorder is not _RECORDER:
+            return recorder.count
+        recorder, _RECORDER = _RECORDER, None
+        for listener in _LISTENERS.values():
+            listener.recorder = None
+    if recorder is None:
+        return 0
+    recorder.close()
+    _LOGGER.info("Recorded %d events to %s", recorder.count, recorder.path)
+    return recorder.count
+
+
+def merge_event(event, data):
+    """Merge an event into an earlier one of the same device"""
+    for key, value in data.items():
+        if isinstance(value, dict) and isinstance(event.get(key), dict):
+            merge_event(event[key], value)
+        else:
+            event[key] = value
+    return event
+
+
+def message_worker(listener):
+    """Wait for messages and pass them on to right device.
+
+    Messages of the same device arriving within the coalesce window are
+    merged so that a burst results in a single dispatch.
+    """
     _LOGGER.debug("Starting Worker Thread.")
-    msg_q = device.messages
+    msg_q = listener.messages
 
     while True:
+        message = msg_q.get()
+        deadline = time.monotonic() + listener.coalesce_window
+        events = {}
 
-        if not msg_q.empty():
-            message = msg_q.get()
-
+        while message is not None:
             data = {}
             try:
                 data = json.loads(message.decode("utf-8"))
@@ -37,25 +1434,39 @@ def message_worker(device):
                 _LOGGER.error("Received invalid message: %s", message)
 
             if 'device_id' in data:
-                device_id = data.get('device_id')
-                if device_id == device.device_id:
-                    device.handle_event(data)
-                else:
-                    _LOGGER.warning("%s: Received message for unknown device.",
-                                    device.ip_address)
+                METRICS.record_event(data['device_id'])
+                merge_event(events.setdefault(data['device_id'], {}), data)
+            msg_q.task_done()
+
+            try:
+                message = msg_q.get(
+                    timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                break
+
+        for device_id, data in events.items():
+            listener.dispatch(device_id, data)
+
+        if message is None:
             msg_q.task_done()
-        time.sleep(0.2)
+            listener.stop_dispatch()
+            _LOGGER.debug("Stopping Worker Thread.")
+            return
 
 
-def socket_worker(sock, msg_q):
+def socket_worker(listener, sock):
     """Socket Loop that fills message queue"""
     _LOGGER.debug("Starting Socket Thread.")
     while True:
         try:
-            data, addr = sock.recvfrom(1024)    # buffer size is 1024 bytes
+            data, addr = sock.recvfrom(EVENT_BUFFER_SIZE)
+        except socket.timeout:
+            continue
         except OSError as err:
+            if sock.fileno() == -1:
+                _LOGGER.debug("Socket closed, stopping Socket Thread.")
+                return
             _LOGGER.error(err)
         else:
             _LOGGER.debug("%s received message: %s from %s", addr, data, addr)
-            msg_q.put(data)
-        time.sleep(0.2)
+            listener.receive(data, addr)
@@ -1,6 +1,12 @@
 """Support for Yamaha MusicCast Receivers."""
+from datetime import timedelta
+import asyncio
 import logging
 import socket
+import threading
+import time
+
+import aiohttp
 
 import custom_components.musiccast_yamaha.pymusiccast as pymusiccast
 import voluptuous as vol
@@ -26,15 +32,38 @@ from homeassistant.const import (
     CONF_HOST,
     CONF_PORT,
     CONF_ZONE,
+    EVENT_HOMEASSISTANT_STOP,
     STATE_IDLE,
     STATE_ON,
     STATE_PAUSED,
     STATE_PLAYING,
     STATE_UNKNOWN,
 )
+from homeassistant.core import callback
 import homeassistant.helpers.config_validation as cv
+from homeassistant.helpers.event import track_time_interval
+from homeassistant.helpers.storage import Store
 import homeassistant.util.dt as dt_util
 from . import DOMAIN
+from .discovery import DEFAULT_HTTP_PORT, discover, ssdp_hosts, subnet_hosts
+from .helpers import (
+    DEFAULT_ART_CACHE_SIZE,
+    DEFAULT_COALESCE_WINDOW,
+    DEFAULT_POLL_MAX_INTERVAL,
+    DEFAULT_POLL_MIN_INTERVAL,
+    DEFAULT_POLL_SILENCE,
+    DEFAULT_POOL_IDLE_TIMEOUT,
+    DEFAULT_POOL_SIZE,
+    DEFAULT_RATE_LIMIT,
+    AlbumArtCache,
+    MetadataStore,
+    album_art_key,
+    async_close_sessions,
+    close_listeners,
+    close_sessions,
+    configure_pool,
+    configure_scheduler,
+)
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -55,43 +84,180 @@ CONF_SOURCE_IGNORE = "source_ignore"
 CONF_SOURCE_NAMES = "source_names"
 
 INTERVAL_SECONDS = "interval_seconds"
+CONF_POOL_SIZE = "pool_size"
+CONF_POOL_IDLE_TIMEOUT = "pool_idle_timeout"
+CONF_COALESCE_WINDOW = "event_coalesce_window"
+CONF_POLL_MIN_INTERVAL = "poll_min_interval"
+CONF_POLL_MAX_INTERVAL = "poll_max_interval"
+CONF_POLL_SILENCE = "poll_silence"
+CONF_RATE_LIMIT = "request_rate_limit"
+CONF_ART_CACHE_SIZE = "album_art_cache_size"
+CONF_ART_DISK_CACHE = "album_art_disk_cache"
+CONF_ART_THUMBNAIL_SIZE = "album_art_thumbnail_size"
+CONF_DISCOVERY_SUBNET = "discovery_subnet"
+CONF_DISCOVERY_SSDP = "discovery_ssdp"
+CONF_DISCOVERY_HTTP_PORT = "discovery_http_port"
+CONF_DISCOVERY_INTERVAL = "discovery_interval"
 
 DEFAULT_PORT = 5005
 DEFAULT_INTERVAL = 480
 DEFAULT_ZONE = 'main'
+DEFAULT_DISCOVERY_INTERVAL = 300
+
+METADATA_STORAGE_KEY = 'musiccast_yamaha.devices'
+METADATA_STORAGE_VERSION = 1
+METADATA_SAVE_DELAY = 10
+ART_CACHE_DIR = 'musiccast_yamaha_art'
+
+POLL_TICK = timedelta(seconds=10)
+STARTUP_DEADLINE = 10
 
 ATTR_MUSICCAST_GROUP = 'musiccast_yamaha_group'
 
-PLATFORM_SCHEMA = PLATFORM_SCHEMA.extend(
+
+def valid_subnet(value):
+    """Validate a subnet small enough to be probed."""
+    try:
+        subnet_hosts(value)
+    except ValueError as err:
+        raise vol.Invalid(str(err))
+    return value
+
+
+PLATFORM_SCHEMA = vol.All(PLATFORM_SCHEMA.extend(
     {
-        vol.Required(CONF_HOST): cv.string,
+        vol.Optional(CONF_HOST): cv.string,
         vol.Optional(CONF_PORT, default=DEFAULT_PORT): cv.port,
         vol.Optional(INTERVAL_SECONDS,
                      default=DEFAULT_INTERVAL): cv.positive_int,
+        vol.Optional(CONF_POOL_SIZE,
+                     default=DEFAULT_POOL_SIZE): cv.positive_int,
+        vol.Optional(CONF_POOL_IDLE_TIMEOUT,
+                     default=DEFAULT_POOL_IDLE_TIMEOUT): cv.positive_int,
+        vol.Optional(CONF_COALESCE_WINDOW,
+                     default=DEFAULT_COALESCE_WINDOW): vol.All(
+                         vol.Coerce(float), vol.Range(min=0)),
+        vol.Optional(CONF_POLL_MIN_INTERVAL,
+                     default=DEFAULT_POLL_MIN_INTERVAL): cv.positive_int,
+        vol.Optional(CONF_POLL_MAX_INTERVAL,
+                     default=DEFAULT_POLL_MAX_INTERVAL): cv.positive_int,
+        vol.Optional(CONF_POLL_SILENCE,
+                     default=DEFAULT_POLL_SILENCE): cv.positive_int,
+        vol.Optional(CONF_RATE_LIMIT,
+                     default=DEFAULT_RATE_LIMIT): vol.All(
+                         vol.Coerce(float), vol.Range(min=0)),
+        vol.Optional(CONF_ART_CACHE_SIZE,
+                     default=DEFAULT_ART_CACHE_SIZE >> 20): cv.positive_int,
+        vol.Optional(CONF_ART_DISK_CACHE, default=False): cv.boolean,
+        vol.Optional(CONF_ART_THUMBNAIL_SIZE, default=0): cv.positive_int,
         vol.Optional(CONF_SOURCE_IGNORE, default=[]): vol.All(
             cv.ensure_list, [cv.string]
         ),
         vol.Optional(CONF_SOURCE_NAMES, default={}): {cv.string: cv.string},
+        vol.Optional(CONF_DISCOVERY_SUBNET): valid_subnet,
+        vol.Optional(CONF_DISCOVERY_SSDP): cv.boolean,
+        vol.Optional(CONF_DISCOVERY_HTTP_PORT,
+                     default=DEFAULT_HTTP_PORT): cv.port,
+        vol.Optional(CONF_DISCOVERY_INTERVAL,
+                     default=DEFAULT_DISCOVERY_INTERVAL): cv.positive_int,
     }
-)
+), cv.has_at_least_one_key(CONF_HOST, CONF_DISCOVERY_SUBNET,
+                           CONF_DISCOVERY_SSDP))
+
+
+class EntityRegistry:
+    """Entities indexed by entity_id and ip address."""
+
+    def __init__(self):
+        """Initialize the indexes."""
+        self._entities = {}
+        self._by_ip = {}
+
+    def __iter__(self):
+        """Iterate over a snapshot of the entities."""
+        return iter(list(self._entities.values()))
+
+    def __len__(self):
+        """Return the number of entities."""
+        return len(self._entities)
+
+    @staticmethod
+    def _index(index, key, entity):
+        """Add an entity under key."""
+        index.setdefault(key, []).append(entity)
+
+    @staticmethod
+    def _unindex(index, key, entity):
+        """Remove an entity from key."""
+        entities = index.get(key, [])
+        if entity in entities:
+            entities.remove(entity)
+        if not entities:
+            index.pop(key, None)
+
+    def add(self, entity):
+        """Record an entity."""
+        self._entities[entity.entity_id] = entity
+        self._index(self._by_ip, entity.ip_address, entity)
+
+    def remove(self, entity):
+        """Forget an entity."""
+        if self._entities.pop(entity.entity_id, None) is None:
+            return
+        self._unindex(self._by_ip, entity.ip_address, entity)
+
+    def get(self, entity_id):
+        """Return the entity of an entity_id."""
+        return self._entities.get(entity_id)
+
+    def by_ip(self, ip_address):
+        """Return the entities of an ip address."""
+        return list(self._by_ip.get(ip_address, []))
 
 
 class MusicCastData:
     """Storage class for platform global data."""
 
-    def __init__(self):
+    def __init__(self, hass, config):
         """Initialize the data."""
         self.hosts = []
-        self.entities = []
+        self.entities = EntityRegistry()
+        self.lock = threading.Lock()
+        self.startup_deadline = time.monotonic() + STARTUP_DEADLINE
+        store = Store(hass, METADATA_STORAGE_VERSION, METADATA_STORAGE_KEY)
+        self.metadata = MetadataStore(
+            asyncio.run_coroutine_threadsafe(store.async_load(),
+                                             hass.loop).result(),
+            save=lambda: hass.add_job(store.async_delay_save,
+                                      self.metadata.data,
+                                      METADATA_SAVE_DELAY))
+        self.album_art = AlbumArtCache(
+            config.get(CONF_ART_CACHE_SIZE) << 20,
+            path=(hass.config.path(ART_CACHE_DIR)
+                  if config.get(CONF_ART_DISK_CACHE) else None),
+            thumbnail_size=config.get(CONF_ART_THUMBNAIL_SIZE))
 
 
 def setup_platform(hass, config, add_entities, discovery_info=None):
     """Set up the Yamaha MusicCast platform."""
 
     if DOMAIN not in hass.data:
-        hass.data[DOMAIN] = MusicCastData()
+        hass.data[DOMAIN] = MusicCastData(hass, config)
+        hass.bus.listen_once(EVENT_HOMEASSISTANT_STOP, close_sessions)
+        hass.bus.listen_once(EVENT_HOMEASSISTANT_STOP, async_close_sessions)
+        hass.bus.listen_once(EVENT_HOMEASSISTANT_STOP, close_listeners)
+
+        @callback
+        def async_poll_due_entities(now):
+            """Refresh the entities that have been silent for too long."""
+            for entity in hass.data[DOMAIN].entities:
+                if entity.poll_due:
+                    entity.async_schedule_update_ha_state(True)
+
+        track_time_interval(hass, async_poll_due_entities, POLL_TICK)
 
-    known_hosts = hass.data[DOMAIN].hosts
+    data = hass.data[DOMAIN]
+    known_hosts = data.hosts
 
     _LOGGER.debug("known_hosts: %s", known_hosts)
 
@@ -101,47 +267,112 @@ def setup_platform(hass, config, add_entities, discovery_info=None):
     source_ignore = config.get(CONF_SOURCE_IGNORE)
     source_names = config.get(CONF_SOURCE_NAMES)
 
-    # Get IP of host to prevent duplicates
-    try:
-        ipaddr = socket.gethostbyname(host)
-    except (OSError) as error:
-        _LOGGER.error("Could not communicate with %s:%d: %s",
-                      host, port, error)
-        return
-
-    if [item for item in known_hosts if item[0] == ipaddr]:
-        _LOGGER.warning("Host %s:%d already registered", host, port)
-        return
-
-    if [item for item in known_hosts if item[1] == port]:
-        _LOGGER.warning("Port %s:%d already registered", host, port)
-        return
-
-    reg_host = (ipaddr, port)
-    known_hosts.append(reg_host)
-
-    try:
-        receiver = pymusiccast.McDevice(ipaddr, udp_port=port,
-                                        mc_interval=interval)
-    except pymusiccast.exceptions.YMCInitError as err:
-        _LOGGER.error(err)
-        receiver = None
-
-    if receiver:
-        for zone in receiver.zones:
-            _LOGGER.debug("Receiver: %s / Port: %d / Zone: %s",
-                          receiver, port, zone)
-            add_entities(
-                [YamahaDevice(
-                    receiver,
-                    receiver.zones[zone],
-                    source_ignore,
-                    source_names
-                )],
-                True
-            )
-    else:
-        known_hosts.remove(reg_host)
+    def init_receiver(host):
+        """Initialize the receiver of the host."""
+        # Get IP of host to prevent duplicates
+        hostname, sep, http_port = host.partition(':')
+        ipaddr = socket.gethostbyname(hostname) + sep + http_port
+
+        with data.lock:
+            if [item for item in known_hosts if item[0] == ipaddr]:
+                _LOGGER.warning("Host %s:%d already registered", host, port)
+                return None
+            reg_host = (ipaddr, port)
+            known_hosts.append(reg_host)
+
+        configure_pool(ipaddr, pool_size=config.get(CONF_POOL_SIZE),
+                       idle_timeout=config.get(CONF_POOL_IDLE_TIMEOUT))
+        configure_scheduler(ipaddr, rate_limit=config.get(CONF_RATE_LIMIT))
+
+        try:
+            return pymusiccast.McDevice(
+                ipaddr, udp_port=port, mc_interval=interval,
+                coalesce_window=config.get(CONF_COALESCE_WINDOW),
+                poll_min_interval=config.get(CONF_POLL_MIN_INTERVAL),
+                poll_max_interval=config.get(CONF_POLL_MAX_INTERVAL),
+                poll_silence=config.get(CONF_POLL_SILENCE),
+                metadata_store=data.metadata)
+        except pymusiccast.exceptions.YMCInitError:
+            with data.lock:
+                known_hosts.remove(reg_host)
+            raise
+
+    def setup_receiver(host):
+        """Add the entities of the receiver, retrying while offline."""
+        delay = pymusiccast.RETRY_MIN_DELAY
+        while True:
+            try:
+                receiver = init_receiver(host)
+                break
+            except (OSError, pymusiccast.exceptions.YMCInitError) as error:
+                _LOGGER.warning("Could not communicate with %s:%d, retrying "
+                                "in %d seconds: %s", host, port, delay, error)
+                time.sleep(delay)
+                delay = min(delay * 2, pymusiccast.RETRY_MAX_DELAY)
+
+        if receiver:
+            for zone in receiver.zones:
+                _LOGGER.debug("Receiver: %s / Port: %d / Zone: %s",
+                              receiver, port, zone)
+                add_entities(
+                    [YamahaDevice(
+                        receiver,
+                        receiver.zones[zone],
+                        source_ignore,
+                        source_names
+                    )],
+                    receiver.available
+                )
+
+    def start_receiver(host):
+        """Set up the receiver of a host in the background."""
+        setup_thread = threading.Thread(
+            name="SetupThread-%s" % host, target=setup_receiver,
+            args=(host,))
+        setup_thread.daemon = True
+        setup_thread.start()
+        return setup_thread
+
+    def discover_receivers(now=None):
+        """Set up the new receivers found on the network."""
+        hosts = []
+        if config.get(CONF_DISCOVERY_SUBNET):
+            hosts += subnet_hosts(config[CONF_DISCOVERY_SUBNET],
+                                  config[CONF_DISCOVERY_HTTP_PORT])
+        if config.get(CONF_DISCOVERY_SSDP):
+            hosts += ssdp_hosts()
+        with data.lock:
+            known = {item[0] for item in known_hosts}
+        candidates = [item for item in dict.fromkeys(hosts)
+                      if item not in known]
+        devices = discover(candidates)
+        for device in devices:
+            _LOGGER.info("Discovered %s (%s) at %s",
+                         device['network_status'].get('network_name'),
+                         device['device_info'].get('model_name'),
+                         device['host'])
+        return [start_receiver(device['host']) for device in devices]
+
+    # Every platform waits for its receivers until the same deadline, the
+    # slow ones are then added in the background when they answer.
+    setup_threads = [start_receiver(host)] if host else []
+    if config.get(CONF_DISCOVERY_SUBNET) or config.get(CONF_DISCOVERY_SSDP):
+        setup_threads += discover_receivers()
+
+        @callback
+        def async_discover_receivers(now):
+            """Look for new receivers in the background."""
+            hass.async_add_executor_job(discover_receivers)
+
+        track_time_interval(
+            hass, async_discover_receivers,
+            timedelta(seconds=config.get(CONF_DISCOVERY_INTERVAL)))
+
+    for setup_thread in setup_threads:
+        setup_thread.join(max(data.startup_deadline - time.monotonic(), 0))
+        if setup_thread.is_alive():
+            _LOGGER.warning("%s is slow to respond, setting it up in the "
+                            "background", setup_thread.name)
 
 
 class YamahaDevice(MediaPlayerEntity):
@@ -175,7 +406,16 @@ class YamahaDevice(MediaPlayerEntity):
 
     async def async_added_to_hass(self):
         """Record entity."""
-        self.hass.data[DOMAIN].entities.append(self)
+        self.hass.data[DOMAIN].entities.add(self)
+
+    async def async_will_remove_from_hass(self):
+        """Forget entity."""
+        self.hass.data[DOMAIN].entities.remove(self)
+
+    @property
+    def available(self):
+        """Return true if the device answers."""
+        return self._recv.available
 
     @property
     def name(self):
@@ -187,6 +427,11 @@ class YamahaDevice(MediaPlayerEntity):
         """Return the ip address of the device."""
         return "{}".format(self._ip_address)
 
+    @property
+    def group_id(self):
+        """Return the distribution group id of the zone."""
+        return self._zone.group_id
+
     @property
     def zone(self):
         """Return the zone of the device."""
@@ -201,8 +446,15 @@ class YamahaDevice(MediaPlayerEntity):
 
     @property
     def should_poll(self):
-        """Push an update after each command."""
-        return True
+        """Events are pushed, silent zones are polled by the scheduler."""
+        return False
+
+    @property
+    def poll_due(self):
+        """Return true if the zone must be polled."""
+        # An unavailable device is polled with backoff until it answers
+        return (self._zone.poll_scheduler.due or
+                (self._recv.available and self._recv.subscription_expiring))
 
     @property
     def is_volume_muted(self):
@@ -250,6 +502,24 @@ class YamahaDevice(MediaPlayerEntity):
         """Image url of current playing media."""
         return self.media_status.media_image_url if self.media_status else None
 
+    @property
+    def media_image_hash(self):
+        """Hash of the album art of the current track."""
+        if not self.media_status or not self.media_status.albumart_url:
+            return None
+        return album_art_key(self.media_image_url,
+                             self.media_status.media_artist,
+                             self.media_status.media_album,
+                             self.media_status.media_track)
+
+    async def async_get_media_image(self):
+        """Fetch the album art once per track through the cache."""
+        key = self.media_image_hash
+        if key is None:
+            return None, None
+        return await self.hass.data[DOMAIN].album_art.async_get(
+            key, self.media_image_url)
+
     @property
     def media_artist(self):
         """Artist of current playing media, music track only."""
@@ -298,18 +568,40 @@ class YamahaDevice(MediaPlayerEntity):
         """Return true if it is a master."""
         return self._zone.group_is_server
 
-    def update(self):
+    @property
+    def group_role(self):
+        """Return the role of the device in its group."""
+        return pymusiccast.GROUPS.role(self._ip_address)
+
+    async def async_update(self):
         """Get the latest details from the device."""
-        _LOGGER.debug("update: %s", self.entity_id)
-        self._recv.update_status()
-        self._zone.update_status()
+        _LOGGER.debug("async_update: %s", self.entity_id)
+        if self.poll_due:
+            old_status = self._zone.status
+            try:
+                await self._recv.async_refresh()
+            except (OSError, ValueError, asyncio.TimeoutError,
+                    aiohttp.ClientError) as err:
+                self.poll_failed(err)
+                return
+            self._recv.available = True
+            self._zone.poll_scheduler.polled(
+                self._zone.status != old_status, self.power == STATE_ON)
         self.refresh_group()
 
+    def poll_failed(self, err):
+        """Mark the device unavailable and back off its polling."""
+        if self._recv.available:
+            _LOGGER.warning("%s: Device is unavailable: %s",
+                            self._ip_address, err)
+        self._recv.available = False
+        self._zone.poll_scheduler.polled(False, False)
+
     def update_hass(self):
         """Push updates to Home Assistant."""
         if self.entity_id:
             _LOGGER.debug("update_hass: pushing updates")
-            self.schedule_update_ha_state(True)
+            self.schedule_update_ha_state()
             return True
         return False
 
@@ -318,95 +610,206 @@ class YamahaDevice(MediaPlayerEntity):
         _LOGGER.debug("Turn device: on")
         self._zone.set_power(True)
 
+    async def async_turn_on(self):
+        """Turn on specified media player or all."""
+        _LOGGER.debug("Turn device: on")
+        await self._zone.async_set_power(True)
+
     def turn_off(self):
         """Turn off specified media player or all."""
         _LOGGER.debug("Turn device: off")
         self._zone.set_power(False)
 
+    async def async_turn_off(self):
+        """Turn off specified media player or all."""
+        _LOGGER.debug("Turn device: off")
+        await self._zone.async_set_power(False)
+
     def media_play(self):
         """Send the media player the command for play/pause."""
         _LOGGER.debug("Play")
         self._recv.set_playback("play")
 
+    async def async_media_play(self):
+        """Send the media player the command for play/pause."""
+        _LOGGER.debug("Play")
+        await self._recv.async_set_playback("play")
+
     def media_pause(self):
         """Send the media player the command for pause."""
         _LOGGER.debug("Pause")
         self._recv.set_playback("pause")
 
+    async def async_media_pause(self):
+        """Send the media player the command for pause."""
+        _LOGGER.debug("Pause")
+        await self._recv.async_set_playback("pause")
+
     def media_stop(self):
         """Send the media player the stop command."""
         _LOGGER.debug("Stop")
         self._recv.set_playback("stop")
 
+    async def async_media_stop(self):
+        """Send the media player the stop command."""
+        _LOGGER.debug("Stop")
+        await self._recv.async_set_playback("stop")
+
     def media_previous_track(self):
         """Send the media player the command for prev track."""
         _LOGGER.debug("Previous")
         self._recv.set_playback("previous")
 
+    async def async_media_previous_track(self):
+        """Send the media player the command for prev track."""
+        _LOGGER.debug("Previous")
+        await self._recv.async_set_playback("previous")
+
     def media_next_track(self):
         """Send the media player the command for next track."""
         _LOGGER.debug("Next")
         self._recv.set_playback("next")
 
+    async def async_media_next_track(self):
+        """Send the media player the command for next track."""
+        _LOGGER.debug("Next")
+        await self._recv.async_set_playback("next")
+
     def mute_volume(self, mute):
         """Send mute command."""
         _LOGGER.debug("Mute volume: %s", mute)
         self._zone.set_mute(mute)
 
+    async def async_mute_volume(self, mute):
+        """Send mute command."""
+        _LOGGER.debug("Mute volume: %s", mute)
+        await self._zone.async_set_mute(mute)
+
     def set_volume_level(self, volume):
         """Set volume level, range 0..1."""
         _LOGGER.debug("Volume level: %.2f / %d",
                       volume, volume * self.volume_max)
         self._zone.set_volume(volume * self.volume_max)
 
+    async def async_set_volume_level(self, volume):
+        """Set volume level, range 0..1."""
+        _LOGGER.debug("Volume level: %.2f / %d",
+                      volume, volume * self.volume_max)
+        await self._zone.async_set_volume(volume * self.volume_max)
+
     def select_source(self, source):
         """Send the media player the command to select input source."""
         _LOGGER.debug("select_source: %s", source)
         self.status = STATE_UNKNOWN
         self._zone.set_input(self._reverse_mapping.get(source, source))
 
+    async def async_select_source(self, source):
+        """Send the media player the command to select input source."""
+        _LOGGER.debug("select_source: %s", source)
+        self.status = STATE_UNKNOWN
+        await self._zone.async_set_input(
+            self._reverse_mapping.get(source, source))
+
+    async def async_apply_state(self, power=None, source=None, volume=None):
+        """Send only the commands needed to reach a state, in order."""
+        sent = []
+        if power is not None and power != (self.power == STATE_ON):
+            await self._zone.async_set_power(power)
+            sent.append('setPower')
+        if power is False:
+            return sent
+        if source is not None:
+            input_id = self._reverse_mapping.get(source, source)
+            if input_id != self._source:
+                self.status = STATE_UNKNOWN
+                await self._zone.async_set_input(input_id)
+                sent.append('setInput')
+        if volume is not None and \
+           int(volume * self.volume_max) != int(self.volume * self.volume_max):
+            await self._zone.async_set_volume(volume * self.volume_max)
+            sent.append('setVolume')
+        return sent
+
     def new_media_status(self, status):
         """Handle updates of the media status."""
         _LOGGER.debug("new media_status arrived")
         self.media_status = status
         self.media_status_received = dt_util.utcnow()
 
+    def new_play_time(self, play_time):
+        """Handle the playback position pushed by the device."""
+        if self.media_status:
+            self.media_status.play_time = play_time
+            self.media_status_received = dt_util.utcnow()
+
     def refresh_group(self):
         """Refresh the entities that are part of the group."""
         _LOGGER.debug("Refreshing group data for entity: %s", self.entity_id)
-        entities = self.hass.data[DOMAIN].entities
-        client_entities = [e for e in entities
-                           if e.ip_address in self._zone.group_clients]
+        registry = self.hass.data[DOMAIN].entities
+        clients = (pymusiccast.GROUPS.clients(self._ip_address)
+                   if self.is_master else [])
+        client_entities = [e for ip_address in clients
+                           for e in registry.by_ip(ip_address)]
         self._musiccast_group = [self] + client_entities
 
-    def update_master(self):
+    def group_changed(self):
+        """Push the new group to Home Assistant."""
+        if self.entity_id:
+            self.refresh_group()
+            self.schedule_update_ha_state()
+
+    def group_masters(self, group_id):
+        """Return the masters of a distribution group."""
+        server = pymusiccast.GROUPS.server(group_id)
+        registry = self.hass.data[DOMAIN].entities
+        return [e for e in registry.by_ip(server) if e.is_master]
+
+    def update_master(self, group_id):
         """Master must confirm its clients are alive."""
+        self.hass.add_job(self.async_update_master, group_id)
+
+    async def async_update_master(self, group_id):
+        """Master must confirm its clients are alive.
+
+        The check drops this client that left, along with any other client
+        no longer on the group or on the mc_link input.
+        """
         _LOGGER.debug("Calling to refresh the master: %s", self.entity_id)
-        masters = [e for e in self.hass.data[DOMAIN].entities
-                   if len(e.musiccast_group) > 1]
-        for master in masters:
-            speakers_ip = [e.ip_address for e in master.musiccast_group]
-            if self._ip_address in speakers_ip:
-                master.zone.distribution_group_check_clients()
+        for master in self.group_masters(group_id):
+            if self._ip_address in master.zone.group_clients:
                 _LOGGER.debug("Refreshing the master: %s", master.entity_id)
+                await master.zone.async_distribution_group_check_clients()
 
     def join_add(self, entities):
         """Form a group by adding other players as clients."""
-        self._zone.distribution_group_add([e.ip_address for e in entities])
+        return self._zone.distribution_group_add(
+            [e.ip_address for e in entities])
+
+    async def async_join_add(self, entities):
+        """Form a group by adding other players as clients."""
+        return await self._zone.async_distribution_group_add(
+            [e.ip_address for e in entities])
 
     def unjoin(self):
         """Remove this client from group. Remove the group if server."""
         if self.is_master:
             self._zone.distribution_group_stop()
         else:
-            masters = [e for e in self.hass.data[DOMAIN].entities
-                       if len(e.musiccast_group) > 1]
-            for master in self.hass.data[DOMAIN].entities:
+            for master in self.group_masters(self.group_id):
+                _LOGGER.debug("The master %s needs to refresh after unjoin",
+                              master.entity_id)
+                master.zone.distribution_group_remove([self._ip_address])
+
+    async def async_unjoin(self):
+        """Remove this client from group. Remove the group if server."""
+        if self.is_master:
+            await self._zone.async_distribution_group_stop()
+        else:
+            for master in self.group_masters(self.group_id):
                 _LOGGER.debug("The master %s needs to refresh after unjoin",
                               master.entity_id)
-                speakers_ip = [e.ip_address for e in master.musiccast_group]
-                if self._ip_address in speakers_ip:
-                    master.zone.distribution_group_remove([self._ip_address])
+                await master.zone.async_distribution_group_remove(
+                    [self._ip_address])
 
     @property
     def device_state_attributes(self):
@@ -1,16 +1,219 @@
 from pymusiccast import exceptions
 from pymusiccast import McDevice
 from pymusiccast import Zone
-from .helpers import request
-from .const import ENDPOINTS, STATE_ON, STATE_OFF
+from pymusiccast.media_status import MediaStatus
+from .helpers import (
+    DEFAULT_COALESCE_WINDOW,
+    DEFAULT_POLL_MAX_INTERVAL,
+    DEFAULT_POLL_MIN_INTERVAL,
+    DEFAULT_POLL_SILENCE,
+    CommandCoalescer,
+    PollScheduler,
+    SingleFlightCache,
+    async_fan_out,
+    async_request,
+    fan_out,
+    get_health,
+    get_listener,
+    request,
+)
+from .const import (
+    ENDPOINTS,
+    STATE_IDLE,
+    STATE_OFF,
+    STATE_ON,
+    STATE_PAUSED,
+    STATE_PLAYING,
+    STATE_UNKNOWN,
+)
 from datetime import datetime
+from requests.exceptions import RequestException
+import asyncio
 import logging
 import random
+import threading
+import time
 _LOGGER = logging.getLogger(__name__)
 
+# The device stops sending events to a port not renewed for 10 minutes
+SUBSCRIPTION_TTL = 600
+# Pushed or polled state younger than this is trusted without a request
+STATE_MAX_AGE = 30
+# Distribution info requests within this many seconds share one response
+DISTRIBUTION_INFO_TTL = 2
+# Play info requests of the zones of a device within this many seconds
+# share one response
+PLAY_INFO_TTL = 2
+# Zones of a device polled within this many seconds share one refresh
+REFRESH_TTL = 5
+# Backoff between attempts to reach an offline device
+RETRY_MIN_DELAY = 5
+RETRY_MAX_DELAY = 300
+
+DISTRIBUTION_CACHE = SingleFlightCache(DISTRIBUTION_INFO_TTL)
+PLAY_INFO_CACHE = SingleFlightCache(PLAY_INFO_TTL)
+
+NULL_GROUP = '00000000000000000000000000000000'
+
+# Zone event flags telling that the status changed without including it
+STATUS_FLAGS = ('status_updated', 'signal_info_updated')
+
+# Inputs described by netusb/getPlayInfo, used when the features of the
+# device do not tell
+NETUSB_INPUTS = (
+    'airplay', 'alexa', 'amazon_music', 'deezer', 'juke', 'mc_link',
+    'napster', 'net_radio', 'pandora', 'qobuz', 'rhapsody', 'server',
+    'siriusxm', 'spotify', 'tidal', 'usb',
+)
+
+PLAYBACK_STATES = {
+    'play': STATE_PLAYING,
+    'stop': STATE_IDLE,
+    'pause': STATE_PAUSED,
+}
+
+# Initialized devices by ip address
+DEVICES = {}
+
+
+def get_distribution_info(ip_address):
+    """Get distribution info from a device, sharing concurrent requests"""
+    req_url = ENDPOINTS["getDistributionInfo"].format(ip_address)
+    return DISTRIBUTION_CACHE.get(ip_address, lambda: request(req_url))
+
+
+async def async_get_distribution_info(ip_address):
+    """Get distribution info from a device, sharing concurrent requests"""
+    req_url = ENDPOINTS["getDistributionInfo"].format(ip_address)
+    return await DISTRIBUTION_CACHE.async_get(
+        ip_address, lambda: async_request(req_url))
+
+
+class GroupGraph:
+    """Distribution groups of all the devices: servers, clients and roles.
+
+    It is updated from the distribution info of every device and calls
+    back the devices whose group membership changed.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._members = {}
+        self._clients = {}
+        self._servers = {}
+        self._listeners = {}
+
+    def subscribe(self, ip_address, callback):
+        """Call back a device when its group membership changes."""
+        with self._lock:
+            self._listeners[ip_address] = callback
+
+    def role(self, ip_address):
+        """Returns the role of a device: server, client or none."""
+        return self._members.get(ip_address, (None, 'none'))[1]
+
+    def server(self, group_id):
+        """Returns the ip address of the server of a group."""
+        return self._servers.get(group_id)
+
+    def clients(self, ip_address):
+        """Returns the ip addresses of the clients of a server."""
+        return sorted(self._clients.get(ip_address, ()))
+
+    def update(self, ip_address, dist_info):
+        """Apply the distribution info of a device."""
+        group_id = dist_info.get('group_id')
+        role = dist_info.get('role', 'none')
+        if not group_id or group_id == NULL_GROUP:
+            group_id, role = None, 'none'
+        clients = set()
+        if role == 'server':
+            clients = {client.get('ip_address') for client
+                       in dist_info.get('client_list') or []}
+
+        with self._lock:
+            old_group_id, old_role = self._members.get(ip_address,
+                                                       (None, 'none'))
+            old_clients = self._clients.get(ip_address, set())
+            if (old_group_id, old_role, old_clients) == \
+               (group_id, role, clients):
+                return
+
+            affected = {ip_address} | old_clients | clients
+            if old_role == 'server':
+                self._clients.pop(ip_address, None)
+                if self._servers.get(old_group_id) == ip_address:
+                    del self._servers[old_group_id]
+            elif old_role == 'client':
+                affected.add(self._servers.get(old_group_id))
+
+            if role == 'none':
+                self._members.pop(ip_address, None)
+            else:
+                self._members[ip_address] = (group_id, role)
+            if role == 'server':
+                self._clients[ip_address] = clients
+                self._servers[group_id] = ip_address
+            elif role == 'client':
+                affected.add(self._servers.get(group_id))
+
+            affected.discard(None)
+            callbacks = [self._listeners[member] for member in affected
+                         if member in self._listeners]
+
+        _LOGGER.debug("%s: Group changed: %s %s, notifying %s", ip_address,
+                      role, group_id, affected)
+        for callback in callbacks:
+            callback()
+
+
+GROUPS = GroupGraph()
+
+
+def client_check(result):
+    """Returns the reason a client must leave, ignoring request errors."""
+    if isinstance(result, Exception):
+        _LOGGER.debug("Could not check client: %r", result)
+        return None
+    return result
+
 
 class McDevice(McDevice):
 
+    def __init__(self, ip_address, udp_port=5005, **kwargs):
+        self._coalesce_window = kwargs.get('coalesce_window',
+                                           DEFAULT_COALESCE_WINDOW)
+        self.poll_options = {
+            'min_interval': kwargs.get('poll_min_interval',
+                                       DEFAULT_POLL_MIN_INTERVAL),
+            'max_interval': kwargs.get('poll_max_interval',
+                                       DEFAULT_POLL_MAX_INTERVAL),
+            'silence': kwargs.get('poll_silence', DEFAULT_POLL_SILENCE),
+        }
+        self.subscribed_at = None
+        self.distribution_info = None
+        self.distribution_updated_at = None
+        self._metadata_store = kwargs.get('metadata_store')
+        self.metadata = {}
+        self.available = False
+        self._refreshes = SingleFlightCache(REFRESH_TTL)
+        super().__init__(ip_address, udp_port=udp_port, **kwargs)
+
+    @property
+    def subscription_expiring(self):
+        """Returns true if the UDP event subscription needs renewal."""
+        if not self.healthy_update_timer or self.subscribed_at is None:
+            return True
+        return time.monotonic() - self.subscribed_at > SUBSCRIPTION_TTL * 0.9
+
+    @property
+    def fresh_distribution_info(self):
+        """Returns the distribution info if it is recent enough."""
+        if self.distribution_updated_at is None or \
+           time.monotonic() - self.distribution_updated_at > STATE_MAX_AGE:
+            return None
+        return self.distribution_info
+
     def initialize_zones(self):
         """initialize receiver zones"""
         zone_list = self.location_info.get('zone_list', {'main': True})
@@ -23,30 +226,325 @@ class McDevice(McDevice):
 
     def initialize(self):
         """initialize the object"""
-        self.network_status = self.get_network_status()
+        metadata = (self._metadata_store.get(self._ip_address)
+                    if self._metadata_store else None)
+        if metadata:
+            _LOGGER.debug("%s: Using stored metadata", self._ip_address)
+            self.handle_metadata(metadata)
+        else:
+            self.handle_metadata(self.fetch_metadata())
+            self.available = True
+        self.initialize_socket()
+        self.initialize_worker()
+        self.initialize_zones()
+        DEVICES[self._ip_address] = self
+        GROUPS.subscribe(self._ip_address, self.handle_group_change)
+        get_health(self._ip_address).subscribe(self.handle_recovery)
+        if metadata:
+            revalidate_thread = threading.Thread(
+                name="MetadataThread", target=self.revalidate_metadata,
+                args=(metadata,))
+            revalidate_thread.daemon = True
+            revalidate_thread.start()
+        else:
+            self.update_distribution_info()
+
+    def fetch_metadata(self):
+        """Get the static metadata from device"""
+        return {
+            'network_status': self.get_network_status(),
+            'location_info': self.get_location_info(),
+            'device_info': self.get_device_info(),
+        }
+
+    def handle_metadata(self, metadata):
+        """Apply and store static metadata"""
+        self.metadata = metadata
+        self.network_status = metadata.get('network_status')
         self.name = self.network_status.get('network_name', 'Unknown')
-        self.location_info = self.get_location_info()
-        self.device_info = self.get_device_info()
+        self.location_info = metadata.get('location_info')
+        self.device_info = metadata.get('device_info')
         self.device_id = (
             self.device_info.get('device_id')
             if self.device_info else "Unknown")
-        self.initialize_socket()
-        self.initialize_worker()
-        self.initialize_zones()
-        self.update_distribution_info()
+        if self._metadata_store:
+            self._metadata_store.set(self._ip_address, metadata)
+
+    def revalidate_metadata(self, metadata):
+        """Check the stored metadata against the device until it answers"""
+        delay = RETRY_MIN_DELAY
+        while True:
+            try:
+                device_info = self.get_device_info()
+                stored_info = metadata.get('device_info') or {}
+                if any(device_info.get(key) != stored_info.get(key) for key in
+                       ('device_id', 'system_version', 'api_version')):
+                    _LOGGER.info("%s: Device changed, refreshing metadata",
+                                 self._ip_address)
+                    self.handle_device_change()
+                self.update_distribution_info()
+                break
+            except (OSError, ValueError, RequestException) as err:
+                _LOGGER.warning("%s: Could not revalidate metadata, retrying "
+                                "in %d seconds: %s", self._ip_address, delay,
+                                err)
+                time.sleep(delay)
+                delay = min(delay * 2, RETRY_MAX_DELAY)
+        self.available = True
+        for zone in self.zones.values():
+            zone.update_hass()
+
+    def handle_device_change(self):
+        """Apply the metadata of another device found at the address"""
+        metadata = self.fetch_metadata()
+        listener = get_listener(self._udp_port, self._coalesce_window)
+        listener.unregister(self)
+        self.handle_metadata(metadata)
+        listener.register(self)
+        # The entities keep the zones they were created with
+        zone_list = self.location_info.get('zone_list', {'main': True})
+        for zone_id in zone_list:
+            if zone_list[zone_id] and zone_id not in self.zones:
+                _LOGGER.warning("%s: Zone %s appeared, restart Home "
+                                "Assistant to add it", self._ip_address,
+                                zone_id)
+        self.zones = {zone_id: zone for zone_id, zone in self.zones.items()
+                      if zone_list.get(zone_id)}
+        # The next poll subscribes to the events of the new device and
+        # fetches its features
+        self.device_features = None
+        self.subscribed_at = None
+        self.handle_recovery()
+
+    def handle_recovery(self):
+        """Poll every zone as soon as the device answers again"""
+        for zone in self.zones.values():
+            zone.poll_scheduler.reset()
+
+    def initialize_socket(self):
+        """register the device with the shared event listener"""
+        get_listener(self._udp_port, self._coalesce_window).register(self)
+
+    def initialize_worker(self):
+        """the shared event listener dispatches the messages"""
+
+    def get_device_info(self):
+        """Get info from device"""
+        req_url = ENDPOINTS["getDeviceInfo"].format(self._ip_address)
+        return request(req_url)
+
+    def get_features(self):
+        """Get features from device"""
+        if 'features' not in self.metadata:
+            req_url = ENDPOINTS["getFeatures"].format(self._ip_address)
+            self.handle_metadata(dict(self.metadata,
+                                      features=request(req_url)))
+        return self.metadata['features']
+
+    def get_location_info(self):
+        """Get location info from device"""
+        req_url = ENDPOINTS["getLocationInfo"].format(self._ip_address)
+        return request(req_url)
+
+    def get_network_status(self):
+        """Get network status from device"""
+        req_url = ENDPOINTS["getNetworkStatus"].format(self._ip_address)
+        return request(req_url)
+
+    def get_status(self):
+        """Get status from device to register/keep alive UDP"""
+        headers = {
+            "X-AppName": "MusicCast/0.1(python)",
+            "X-AppPort": str(self._udp_port)
+        }
+        req_url = ENDPOINTS["getStatus"].format(self.ip_address, 'main')
+        return request(req_url, headers=headers)
+
+    def get_play_info(self):
+        """Get play info from device"""
+        req_url = ENDPOINTS["getPlayInfo"].format(self._ip_address)
+        return request(req_url)
+
+    def set_playback(self, playback):
+        """Send Playback command."""
+        req_url = ENDPOINTS["setPlayback"].format(self._ip_address)
+        params = {"playback": playback}
+        return request(req_url, params=params)
+
+    async def async_get_features(self):
+        """Get features from device"""
+        if 'features' not in self.metadata:
+            req_url = ENDPOINTS["getFeatures"].format(self._ip_address)
+            self.handle_metadata(dict(self.metadata,
+                                      features=await async_request(req_url)))
+        return self.metadata['features']
+
+    async def async_get_status(self):
+        """Get status from device to register/keep alive UDP"""
+        headers = {
+            "X-AppName": "MusicCast/0.1(python)",
+            "X-AppPort": str(self._udp_port)
+        }
+        req_url = ENDPOINTS["getStatus"].format(self.ip_address, 'main')
+        return await async_request(req_url, headers=headers)
+
+    async def async_set_playback(self, playback):
+        """Send Playback command."""
+        req_url = ENDPOINTS["setPlayback"].format(self._ip_address)
+        params = {"playback": playback}
+        return await async_request(req_url, params=params)
+
+    def handle_status(self):
+        """Handle status from device"""
+        status = self.get_status()
+        self.subscribed_at = time.monotonic()
+
+        if status:
+            # Update main-zone
+            self.zones['main'].update_status(status)
+
+    async def async_handle_status(self):
+        """Handle status from device"""
+        status = await self.async_get_status()
+        self.subscribed_at = time.monotonic()
+
+        if status:
+            # Update main-zone
+            self.zones['main'].update_status(status)
+
+    async def async_update_status(self, reset=False):
+        """Update device status."""
+        if self.healthy_update_timer and not reset:
+            return
+
+        # get device features only once
+        if not self.device_features:
+            self.handle_features(await self.async_get_features())
+
+        # Get status from device to register/keep alive UDP
+        await self.async_handle_status()
+
+        # Schedule next execution
+        self.setup_update_timer()
+
+    async def async_refresh(self):
+        """Refresh the device once for all the zones polled together"""
+        return await self._refreshes.async_get(self._ip_address,
+                                               self._async_refresh)
+
+    async def _async_refresh(self):
+        """Renew the subscription if needed and get every zone status"""
+        renewed = self.subscription_expiring
+        if renewed:
+            await self.async_update_status(reset=True)
+        zones = [zone for zone in self.zones.values()
+                 if not (renewed and zone.zone_id == 'main')]
+        statuses = await asyncio.gather(
+            *[zone.async_get_status() for zone in zones])
+        for zone, status in zip(zones, statuses):
+            zone.update_status(status)
+        await self.async_update_play_info()
+        return True
+
+    def setup_update_timer(self, reset=False):
+        """Schedule a Timer Thread, replacing a pending one."""
+        if self.update_status_timer:
+            self.update_status_timer.cancel()
+        super().setup_update_timer(reset)
 
     def update_distribution_info(self):
         """Get distribution info from device and update zone"""
-        req_url = ENDPOINTS["getDistributionInfo"].format(self._ip_address)
-        response = request(req_url)
+        self.handle_distribution_info(
+            get_distribution_info(self._ip_address))
+
+    async def async_update_distribution_info(self):
+        """Get distribution info from device and update zone"""
+        self.handle_distribution_info(
+            await async_get_distribution_info(self._ip_address))
+
+    def handle_distribution_info(self, response):
+        """Pass distribution info to the server zone"""
         _LOGGER.debug("%s: Distribution Info Message: %s", self._ip_address,
                       response)
+        self.distribution_info = response
+        self.distribution_updated_at = time.monotonic()
         if 'server_zone' in response:
             server_zone = response.get('server_zone')
             self.zones[server_zone].update_distribution_info(response)
         else:
             self.zones['main'].update_distribution_info(response)
 
+    def handle_group_change(self):
+        """Let every zone refresh its group"""
+        for zone in self.zones.values():
+            zone.group_changed()
+
+    def handle_zone_event(self, zone, message):
+        """Merge the event into the zone status, fetching it if needed"""
+        message = dict(message)
+        status_updated = any([message.pop(flag, False)
+                              for flag in STATUS_FLAGS])
+        # A zone never polled yet lacks max_volume and the rest of its status
+        if status_updated or zone.status is None:
+            message.update(zone.get_status())
+        if message:
+            zone.update_status(message)
+
+    @property
+    def netusb_inputs(self):
+        """Returns the inputs described by the play info."""
+        input_list = (self.device_features or {}).get(
+            'system', {}).get('input_list')
+        if not input_list:
+            return NETUSB_INPUTS
+        return [item.get('id') for item in input_list
+                if item.get('play_info_type') == 'netusb']
+
+    def plays_netusb(self, status):
+        """Returns true if a zone status is powered on a netusb input"""
+        return bool(status) and status.get('power') == 'on' and \
+            status.get('input') in self.netusb_inputs
+
+    def play_info_zones(self, unknown=False):
+        """Returns the zones powered on a netusb input"""
+        return [zone for zone in self.zones.values()
+                if (zone.status is None and unknown) or
+                self.plays_netusb(zone.status)]
+
+    def update_play_info(self, updated=False):
+        """Fetch the play info once for all the zones that need it"""
+        zones = self.play_info_zones(unknown=updated)
+        if not zones:
+            return
+        if updated:
+            PLAY_INFO_CACHE.invalidate(self._ip_address)
+        play_info = PLAY_INFO_CACHE.get(self._ip_address,
+                                        self.get_play_info)
+        for zone in zones:
+            zone.handle_play_info(play_info)
+
+    async def async_update_play_info(self, updated=False):
+        """Fetch the play info once for all the zones that need it"""
+        zones = self.play_info_zones(unknown=updated)
+        if not zones:
+            return
+        if updated:
+            PLAY_INFO_CACHE.invalidate(self._ip_address)
+        play_info = await PLAY_INFO_CACHE.async_get(
+            self._ip_address, lambda: async_request(
+                ENDPOINTS["getPlayInfo"].format(self._ip_address)))
+        for zone in zones:
+            zone.handle_play_info(play_info)
+
+    def handle_netusb(self, message):
+        """Handles 'netusb' in message"""
+        if 'play_time' in message:
+            for zone in self.play_info_zones():
+                zone.new_play_time(message['play_time'])
+        if 'play_info_updated' in message:
+            self.update_play_info(updated=True)
+        return 0
+
     def handle_event(self, message):
         """Dispatch all event messages"""
         # _LOGGER.debug(message)
@@ -55,7 +553,8 @@ class McDevice(McDevice):
             if zone in message:
                 _LOGGER.debug("%s: Received message for zone: %s: %s",
                               self._ip_address, zone, message)
-                self.zones[zone].update_status(message[zone])
+                self.zones[zone].poll_scheduler.event_received()
+                self.handle_zone_event(self.zones[zone], message[zone])
 
         if 'netusb' in message:
             needs_update += self.handle_netusb(message['netusb'])
@@ -63,6 +562,9 @@ class McDevice(McDevice):
         if 'dist' in message:
             _LOGGER.debug("%s: Received dist update for zone %s: %s",
                           self._ip_address, zone, message)
+            # the event tells the cached info is outdated, fetch it again
+            # so that the other devices checking this one can share it
+            DISTRIBUTION_CACHE.invalidate(self._ip_address)
             self.update_distribution_info()
 
         if needs_update > 0:
@@ -74,8 +576,12 @@ class McDevice(McDevice):
 class Zone(Zone):
 
     def __init__(self, receiver, zone_id='main'):
-        super().__init__(receiver)
+        super().__init__(receiver, zone_id)
         self._distribution_info = None
+        self.status_updated_at = None
+        self.poll_scheduler = PollScheduler(**receiver.poll_options)
+        self.commands = CommandCoalescer(
+            "%s/%s" % (receiver.ip_address, zone_id))
 
     @property
     def distribution_info(self):
@@ -89,13 +595,13 @@ class Zone(Zone):
     @property
     def group_id(self):
         """Returns the distribution group id."""
-        return self._distribution_info.get("group_id")
+        return (self._distribution_info or {}).get("group_id")
 
     @property
     def group_is_server(self):
         """Returns true if this zone believes it is a server."""
-        return self._distribution_info.get('role') == 'server' and \
-            self.group_id != '00000000000000000000000000000000'
+        return (self._distribution_info or {}).get('role') == 'server' and \
+            self.group_id != NULL_GROUP
 
     @property
     def group_clients(self):
@@ -112,6 +618,136 @@ class Zone(Zone):
         """Returns the receiver."""
         return self._receiver
 
+    @property
+    def fresh_status(self):
+        """Returns the status if it is recent enough."""
+        if self.status_updated_at is None or \
+           time.monotonic() - self.status_updated_at > STATE_MAX_AGE:
+            return None
+        return self.status
+
+    def group_changed(self):
+        """Let HASS refresh the group."""
+        if self._yamaha:
+            self._yamaha.group_changed()
+
+    def update_status(self, new_status=None):
+        """Updates the zone status."""
+        if new_status is not None:
+            self.status_updated_at = time.monotonic()
+        super().update_status(new_status)
+
+    def handle_message(self, message):
+        """Process the status, forgetting the playback off netusb inputs."""
+        super().handle_message(message)
+        # The play info no longer describes a zone off a netusb input or
+        # powered off, so it will not be refreshed for it anymore
+        if self._yamaha and not self.receiver.plays_netusb(message) and \
+           (self._yamaha.status != STATE_UNKNOWN or
+                self._yamaha.media_status is not None):
+            _LOGGER.debug("%s: Zone %s left the netusb inputs",
+                          self._ip_address, self.zone_id)
+            self._yamaha.status = STATE_UNKNOWN
+            self._yamaha.new_media_status(None)
+
+    def handle_play_info(self, play_info):
+        """Pass the play info of the device to HASS."""
+        if not self._yamaha or not play_info:
+            return
+        needs_update = False
+        media_status = MediaStatus(play_info, self._ip_address)
+        if self._yamaha.media_status != media_status:
+            self._yamaha.new_media_status(media_status)
+            needs_update = True
+        status = PLAYBACK_STATES.get(play_info.get('playback'),
+                                     STATE_UNKNOWN)
+        if self._yamaha.status != status:
+            _LOGGER.debug("%s: playback: %s", self._ip_address, status)
+            self._yamaha.status = status
+            needs_update = True
+        if needs_update:
+            self.update_hass()
+
+    def new_play_time(self, play_time):
+        """Pass the playback position to HASS."""
+        if self._yamaha:
+            self._yamaha.new_play_time(play_time)
+
+    def client_failure(self, dist_info, status=None):
+        """Returns why a client does not serve this group anymore."""
+        if dist_info.get('role') != 'client' or \
+           dist_info.get('group_id') != self.group_id:
+            return "not a client of group %s" % self.group_id
+        if status is not None and status.get('input') != "mc_link":
+            return "input is %s" % status.get('input')
+        return None
+
+    def get_status(self):
+        """Get status from device"""
+        req_url = ENDPOINTS["getStatus"].format(self.ip_address, self.zone_id)
+        return request(req_url)
+
+    def set_power(self, power):
+        """Send Power command."""
+        req_url = ENDPOINTS["setPower"].format(self.ip_address, self.zone_id)
+        params = {"power": "on" if power else "standby"}
+        return self.commands.submit(
+            'setPower', lambda: request(req_url, params=params))
+
+    def set_mute(self, mute):
+        """Send mute command."""
+        req_url = ENDPOINTS["setMute"].format(self.ip_address, self.zone_id)
+        params = {"enable": "true" if mute else "false"}
+        return self.commands.submit(
+            'setMute', lambda: request(req_url, params=params))
+
+    def set_volume(self, volume):
+        """Send Volume command."""
+        req_url = ENDPOINTS["setVolume"].format(self.ip_address, self.zone_id)
+        params = {"volume": int(volume)}
+        return self.commands.submit(
+            'setVolume', lambda: request(req_url, params=params))
+
+    def set_input(self, input_id):
+        """Send Input command."""
+        req_url = ENDPOINTS["setInput"].format(self.ip_address, self.zone_id)
+        params = {"input": input_id}
+        return self.commands.submit(
+            'setInput', lambda: request(req_url, params=params))
+
+    async def async_get_status(self):
+        """Get status from device"""
+        req_url = ENDPOINTS["getStatus"].format(self.ip_address, self.zone_id)
+        return await async_request(req_url)
+
+    async def async_set_power(self, power):
+        """Send Power command."""
+        req_url = ENDPOINTS["setPower"].format(self.ip_address, self.zone_id)
+        params = {"power": "on" if power else "standby"}
+        return await self.commands.async_submit(
+            'setPower', lambda: async_request(req_url, params=params))
+
+    async def async_set_mute(self, mute):
+        """Send mute command."""
+        req_url = ENDPOINTS["setMute"].format(self.ip_address, self.zone_id)
+        params = {"enable": "true" if mute else "false"}
+        return await self.commands.async_submit(
+            'setMute', lambda: async_request(req_url, params=params))
+
+    async def async_set_volume(self, volume):
+        """Send Volume command."""
+        req_url = ENDPOINTS["setVolume"].format(self.ip_address, self.zone_id)
+        params = {"volume": int(volume)}
+        return await self.commands.async_submit(
+            'setVolume', lambda: async_request(req_url, params=params))
+
+    async def async_set_input(self, input_id):
+        """Send Input command."""
+        req_url = ENDPOINTS["setInput"].format(self.ip_address, self.zone_id)
+        params = {"input": input_id}
+        return await self.commands.async_submit(
+            'setInput', lambda: async_request(req_url, params=params))
+
     def update_distribution_info(self, new_dist=None):
         """Get distribution info from device and update zone"""
         _LOGGER.debug("%s: update_distribution_info: Zone %s",
@@ -131,16 +767,16 @@ class Zone(Zone):
         _LOGGER.debug("%s: old_dist: %s", self._ip_address, old_dist)
         _LOGGER.debug("%s: new_dist: %s", self._ip_address, new_dist)
         if old_dist.get('role') != 'server':
-            null_group = '00000000000000000000000000000000'
-            if (old_dist.get('group_id') != null_group and
-                    new_dist.get('group_id') == null_group) or \
+            if (old_dist.get('group_id') != NULL_GROUP and
+                    new_dist.get('group_id') == NULL_GROUP) or \
                (old_dist.get('role') == 'client' and
                     new_dist.get('role') == 'none'):
                 # The client has left, the master must update its client list
                 if self._yamaha:
-                    self._yamaha.update_master()
+                    self._yamaha.update_master(old_dist.get('group_id'))
         self._status_sent = False
         self.distribution_info = new_dist
+        GROUPS.update(self._ip_address, new_dist)
 
         if not self._status_sent:
             self._status_sent = self.update_hass()
@@ -151,22 +787,38 @@ class Zone(Zone):
         payload = {'name': group_name}
         return request(req_url, method='POST', json=payload)
 
+    async def async_distribution_group_set_name(self, group_name):
+        """For SERVER: Set the new name of the group"""
+        req_url = ENDPOINTS["setGroupName"].format(self._ip_address)
+        payload = {'name': group_name}
+        return await async_request(req_url, method='POST', json=payload)
+
     def distribution_group_add(self, clients):
-        """For SERVER: Add clients to distribution group and start serving."""
+        """For SERVER: Add clients to distribution group and start serving.
+        Returns the clients that failed to join."""
         if not clients:
-            return
+            return {}
         group_id = self.group_id
-        if group_id == '00000000000000000000000000000000':
+        if group_id == NULL_GROUP:
             group_id = '%032x' % random.randrange(16**32)
         _LOGGER.debug("%s: Setting the clients to be clients: %s",
                       self._ip_address, clients)
-        for client in clients:
+
+        def set_client_info(client):
             req_url = ENDPOINTS["setClientInfo"].format(client)
             payload = {'group_id': group_id,
                        'zone': self._zone_id,
                        'server_ip_address': self._ip_address
                        }
-            request(req_url, method='POST', json=payload)
+            return request(req_url, method='POST', json=payload)
+
+        failed = fan_out(set_client_info, clients)
+        if failed:
+            _LOGGER.warning("%s: Clients failed to join the group: %s",
+                            self._ip_address, failed)
+            clients = [c for c in clients if c not in failed]
+            if not clients:
+                return failed
 
         _LOGGER.debug("%s: adding to the server the clients: %s",
                       self._ip_address, clients)
@@ -180,6 +832,48 @@ class Zone(Zone):
         req_url = ENDPOINTS["startDistribution"].format(self.ip_address)
         params = {"num": int(0)}
         request(req_url, params=params)
+        return failed
+
+    async def async_distribution_group_add(self, clients):
+        """For SERVER: Add clients to distribution group and start serving.
+        Returns the clients that failed to join."""
+        if not clients:
+            return {}
+        group_id = self.group_id
+        if group_id == NULL_GROUP:
+            group_id = '%032x' % random.randrange(16**32)
+        _LOGGER.debug("%s: Setting the clients to be clients: %s",
+                      self._ip_address, clients)
+
+        async def set_client_info(client):
+            req_url = ENDPOINTS["setClientInfo"].format(client)
+            payload = {'group_id': group_id,
+                       'zone': self._zone_id,
+                       'server_ip_address': self._ip_address
+                       }
+            return await async_request(req_url, method='POST', json=payload)
+
+        failed = await async_fan_out(set_client_info, clients)
+        if failed:
+            _LOGGER.warning("%s: Clients failed to join the group: %s",
+                            self._ip_address, failed)
+            clients = [c for c in clients if c not in failed]
+            if not clients:
+                return failed
+
+        _LOGGER.debug("%s: adding to the server the clients: %s",
+                      self._ip_address, clients)
+        req_url = ENDPOINTS["setServerInfo"].format(self._ip_address)
+        payload = {'group_id': group_id,
+                   'type': 'add',
+                   'client_list': clients}
+        await async_request(req_url, method='POST', json=payload)
+
+        _LOGGER.debug("%s: Starting the distribution", self._ip_address)
+        req_url = ENDPOINTS["startDistribution"].format(self.ip_address)
+        params = {"num": int(0)}
+        await async_request(req_url, params=params)
+        return failed
 
     def distribution_group_check_clients(self):
         """For SERVER: Checking clients are still serving this group."""
@@ -187,29 +881,69 @@ class Zone(Zone):
             return
         _LOGGER.debug("%s: Checking client status. Current registered \
                       clients: %s", self._ip_address, self.group_clients)
-        clients_to_remove = []
-        for client in self.group_clients:
-            # check if it is still a client with correct group and input
-            req_url = ENDPOINTS["getDistributionInfo"].format(client)
-            response = request(req_url)
-            if response.get('role') != 'client' or \
-               response.get('group_id') != self.group_id:
-                clients_to_remove.append(client)
-                continue
-            req_url = ENDPOINTS["getStatus"].format(client, self.zone_id)
-            response = request(req_url)
-            if response.get('input') != "mc_link":
-                clients_to_remove.append(client)
+
+        def check_client(client):
+            # check if it is still a client with correct group and input,
+            # trusting the recent state of the devices we are listening to
+            device = DEVICES.get(client)
+            zone = device.zones.get(self.zone_id) if device else None
+            dist_info = device.fresh_distribution_info if device else None
+            if dist_info is None:
+                dist_info = get_distribution_info(client)
+            failure = self.client_failure(dist_info)
+            if failure:
+                return failure
+            status = zone.fresh_status if zone else None
+            if status is None:
+                req_url = ENDPOINTS["getStatus"].format(client, self.zone_id)
+                status = request(req_url)
+            return self.client_failure(dist_info, status)
+
+        clients_to_remove = list(fan_out(
+            check_client, self.group_clients, check=client_check))
         if clients_to_remove:
             _LOGGER.debug("%s: Clients: %s does not seem to be connected \
                           anymore... removing it.", self._ip_address,
                           clients_to_remove)
             self.distribution_group_remove(clients_to_remove)
 
+    async def async_distribution_group_check_clients(self):
+        """For SERVER: Checking clients are still serving this group."""
+        if not self.group_is_server:
+            return
+        _LOGGER.debug("%s: Checking client status. Current registered \
+                      clients: %s", self._ip_address, self.group_clients)
+
+        async def check_client(client):
+            # check if it is still a client with correct group and input,
+            # trusting the recent state of the devices we are listening to
+            device = DEVICES.get(client)
+            zone = device.zones.get(self.zone_id) if device else None
+            dist_info = device.fresh_distribution_info if device else None
+            if dist_info is None:
+                dist_info = await async_get_distribution_info(client)
+            failure = self.client_failure(dist_info)
+            if failure:
+                return failure
+            status = zone.fresh_status if zone else None
+            if status is None:
+                req_url = ENDPOINTS["getStatus"].format(client, self.zone_id)
+                status = await async_request(req_url)
+            return self.client_failure(dist_info, status)
+
+        clients_to_remove = list(await async_fan_out(
+            check_client, self.group_clients, check=client_check))
+        if clients_to_remove:
+            _LOGGER.debug("%s: Clients: %s does not seem to be connected \
+                          anymore... removing it.", self._ip_address,
+                          clients_to_remove)
+            await self.async_distribution_group_remove(clients_to_remove)
+
     def distribution_group_remove(self, clients):
-        """For SERVER: Remove clients, stop distribution if no more."""
+        """For SERVER: Remove clients, stop distribution if no more.
+        Returns the clients that failed to leave."""
         if not self.group_is_server or not clients:
-            return
+            return {}
         old_clients = self.group_clients.copy()
 
         for client in clients:
@@ -241,12 +975,67 @@ class Zone(Zone):
             _LOGGER.debug("%s: Stopping the distribution", self._ip_address)
             request(req_url)
 
+        def reset_client_info(client):
+            _LOGGER.debug("%s: Resetting client: %s", self._ip_address, client)
+            req_url = ENDPOINTS["setClientInfo"].format(client)
+            payload = {'group_id': '',
+                       'zone': self._zone_id}
+            return request(req_url, method='POST', json=payload)
+
+        failed = fan_out(reset_client_info, clients)
+        if failed:
+            _LOGGER.warning("%s: Clients failed to leave the group: %s",
+                            self._ip_address, failed)
+        return failed
+
+    async def async_distribution_group_remove(self, clients):
+        """For SERVER: Remove clients, stop distribution if no more.
+        Returns the clients that failed to leave."""
+        if not self.group_is_server or not clients:
+            return {}
+        old_clients = self.group_clients.copy()
+
         for client in clients:
+            if client in old_clients:
+                old_clients.remove(client)
+
+        _LOGGER.debug("%s: Removing from server the clients: %s",
+                      self._ip_address, clients)
+        req_url = ENDPOINTS["setServerInfo"].format(self._ip_address)
+        payload = {'group_id': self.group_id,
+                   'type': 'remove',
+                   'client_list': clients}
+        await async_request(req_url, method='POST', json=payload)
+
+        if old_clients:
+            req_url = ENDPOINTS["startDistribution"].format(self.ip_address)
+            params = {"num": int(0)}
+            _LOGGER.debug("%s: Updating the distribution with remaining \
+                          clients: %s", self._ip_address, old_clients)
+            await async_request(req_url, params=params)
+        else:
+            _LOGGER.debug("%s: No more clients, resetting server",
+                          self._ip_address)
+            req_url = ENDPOINTS["setServerInfo"].format(self._ip_address)
+            payload = {'group_id': ''}
+            await async_request(req_url, method='POST', json=payload)
+
+            req_url = ENDPOINTS["stopDistribution"].format(self.ip_address)
+            _LOGGER.debug("%s: Stopping the distribution", self._ip_address)
+            await async_request(req_url)
+
+        async def reset_client_info(client):
             _LOGGER.debug("%s: Resetting client: %s", self._ip_address, client)
             req_url = ENDPOINTS["setClientInfo"].format(client)
             payload = {'group_id': '',
                        'zone': self._zone_id}
-            request(req_url, method='POST', json=payload)
+            return await async_request(req_url, method='POST', json=payload)
+
+        failed = await async_fan_out(reset_client_info, clients)
+        if failed:
+            _LOGGER.warning("%s: Clients failed to leave the group: %s",
+                            self._ip_address, failed)
+        return failed
 
     def distribution_group_stop(self):
         """For SERVER: Remove all clients and stop the distribution group."""
@@ -256,6 +1045,14 @@ class Zone(Zone):
                       self.group_clients)
         self.distribution_group_remove(self.group_clients)
 
+    async def async_distribution_group_stop(self):
+        """For SERVER: Remove all clients and stop the distribution group."""
+        if not self.group_is_server:
+            return
+        _LOGGER.debug("%s: stopDistribution client_list: %s", self._ip_address,
+                      self.group_clients)
+        await self.async_distribution_group_remove(self.group_clients)
+
     def distribution_group_leave(self):
         """For CLIENT: The client disconnect from group.
         (The server will need to then updates its group)"""
@@ -267,3 +1064,15 @@ class Zone(Zone):
         payload = {'group_id': '',
                    'zone': self._zone_id}
         request(req_url, method='POST', json=payload)
+
+    async def async_distribution_group_leave(self):
+        """For CLIENT: The client disconnect from group.
+        (The server will need to then updates its group)"""
+        if self.group_is_server:
+            await self.async_distribution_group_stop()
+            return
+        _LOGGER.debug("%s: client is leaving the group", self._ip_address)
+        req_url = ENDPOINTS["setClientInfo"].format(self.ip_address)
+        payload = {'group_id': '',
+                   'zone': self._zone_id}
+        await async_request(req_url, method='POST', json=payload)
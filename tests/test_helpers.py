@@ -0,0 +1,391 @@
+"""Tests of the request, cache and event helpers."""
+import asyncio
+import importlib.util
+import json
+import os
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+HELPERS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))), 'custom_components', 'musiccast_yamaha', 'helpers.py')
+
+
+def load_helpers():
+    """Import helpers.py without the Home Assistant package around it."""
+    spec = importlib.util.spec_from_file_location('musiccast_helpers',
+                                                  HELPERS)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+helpers = load_helpers()
+
+
+class SlowHandler(BaseHTTPRequestHandler):
+    """Answer every request with an empty JSON object after a while."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        """Answer a request."""
+        time.sleep(0.2)
+        body = json.dumps({'response_code': 0}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        """Keep the output quiet."""
+
+
+def command(sent, value, delay=0):
+    """Returns a send coroutine function recording value in sent."""
+    async def send():
+        await asyncio.sleep(delay)
+        sent.append(value)
+        return value
+    return send
+
+
+class CommandCoalescerTest(unittest.TestCase):
+    """CommandCoalescer keeps working when callers are cancelled."""
+
+    def test_cancelled_superseded_caller(self):
+        """A cancelled waiter neither breaks the sender nor the key."""
+        coalescer = helpers.CommandCoalescer('test')
+        sent = []
+
+        async def scenario():
+            first = asyncio.ensure_future(
+                coalescer.async_submit('setVolume', command(sent, 1, 0.05)))
+            await asyncio.sleep(0.01)
+            second = asyncio.ensure_future(
+                coalescer.async_submit('setVolume', command(sent, 2)))
+            await asyncio.sleep(0.01)
+            second.cancel()
+            self.assertEqual(await first, 1)
+            with self.assertRaises(asyncio.CancelledError):
+                await second
+            return await asyncio.wait_for(
+                coalescer.async_submit('setVolume', command(sent, 3)), 1)
+
+        self.assertEqual(asyncio.run(scenario()), 3)
+        self.assertEqual(sent, [1, 2, 3])
+
+    def test_cancelled_sender(self):
+        """The value queued behind a cancelled sender still goes out."""
+        coalescer = helpers.CommandCoalescer('test')
+        sent = []
+
+        async def scenario():
+            first = asyncio.ensure_future(
+                coalescer.async_submit('setPower', command(sent, 'on', 0.05)))
+            await asyncio.sleep(0.01)
+            second = asyncio.ensure_future(
+                coalescer.async_submit('setPower', command(sent, 'off')))
+            await asyncio.sleep(0.01)
+            first.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await first
+            return await asyncio.wait_for(second, 1)
+
+        self.assertEqual(asyncio.run(scenario()), 'off')
+        self.assertEqual(sent, ['on', 'off'])
+
+
+class MetadataStoreTest(unittest.TestCase):
+    """MetadataStore saves only the changes."""
+
+    def test_saves_changes_only(self):
+        """Storing the loaded metadata again does not save."""
+        saves = []
+        store = helpers.MetadataStore({'host': {'device_info': {}}},
+                                      save=lambda: saves.append(store.data()))
+        store.set('host', {'device_info': {}})
+        self.assertEqual(saves, [])
+        store.set('host', {'device_info': {}, 'features': {}})
+        self.assertEqual(saves, [{'host': {'device_info': {},
+                                           'features': {}}}])
+
+
+class AlbumArtCacheTest(unittest.TestCase):
+    """AlbumArtCache shares a fetch with every waiter until it ends."""
+
+    def scenario(self, load, stop_owner):
+        """Returns what a waiter gets when the owner fetch stops."""
+        cache = helpers.AlbumArtCache()
+        cache._async_load = load
+
+        async def run():
+            owner = asyncio.ensure_future(cache.async_get('key', 'url'))
+            await asyncio.sleep(0.01)
+            waiter = asyncio.ensure_future(cache.async_get('key', 'url'))
+            await asyncio.sleep(0.01)
+            stop_owner(owner)
+            try:
+                await owner
+            except (asyncio.CancelledError, RuntimeError):
+                pass
+            return await asyncio.wait_for(waiter, 1)
+
+        return asyncio.run(run())
+
+    def test_cancelled_owner(self):
+        """The waiters still get the image when the owner is cancelled."""
+        async def load(key, url, loop):
+            await asyncio.sleep(0.05)
+            return b'art', 'image/jpeg'
+
+        self.assertEqual(self.scenario(load, lambda owner: owner.cancel()),
+                         (b'art', 'image/jpeg'))
+
+    def test_failed_owner(self):
+        """The waiters get no image when the fetch raises."""
+        async def load(key, url, loop):
+            await asyncio.sleep(0.05)
+            raise RuntimeError('failed')
+
+        self.assertEqual(self.scenario(load, lambda owner: None),
+                         (None, None))
+
+
+class SingleFlightCacheTest(unittest.TestCase):
+    """SingleFlightCache shares loads without serving stale ones."""
+
+    def test_cancelled_waiter(self):
+        """A cancelled waiter does not fail the load it joined."""
+        cache = helpers.SingleFlightCache(10)
+
+        async def load():
+            await asyncio.sleep(0.05)
+            return 'loaded'
+
+        async def scenario():
+            owner = asyncio.ensure_future(cache.async_get('key', load))
+            await asyncio.sleep(0.01)
+            waiter = asyncio.ensure_future(cache.async_get('key', load))
+            await asyncio.sleep(0.01)
+            waiter.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await waiter
+            return await owner
+
+        self.assertEqual(asyncio.run(scenario()), 'loaded')
+
+    def test_cancelled_owner(self):
+        """A cancelled owner does not fail the waiters of its load."""
+        cache = helpers.SingleFlightCache(10)
+
+        async def load():
+            await asyncio.sleep(0.05)
+            return 'loaded'
+
+        async def scenario():
+            owner = asyncio.ensure_future(cache.async_get('key', load))
+            await asyncio.sleep(0.01)
+            waiter = asyncio.ensure_future(cache.async_get('key', load))
+            await asyncio.sleep(0.01)
+            owner.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await owner
+            return await waiter, await cache.async_get('key', load)
+
+        self.assertEqual(asyncio.run(scenario()), ('loaded', 'loaded'))
+
+    def test_invalidate_detaches_load(self):
+        """Callers after invalidate do not join the earlier load."""
+        cache = helpers.SingleFlightCache(10)
+        loads = iter(['before', 'after'])
+
+        async def load():
+            value = next(loads)
+            await asyncio.sleep(0.05)
+            return value
+
+        async def scenario():
+            first = asyncio.ensure_future(cache.async_get('key', load))
+            await asyncio.sleep(0.01)
+            cache.invalidate('key')
+            second = await cache.async_get('key', load)
+            return await first, second, await cache.async_get('key', load)
+
+        self.assertEqual(asyncio.run(scenario()),
+                         ('before', 'after', 'after'))
+
+
+class RequestSchedulerTest(unittest.TestCase):
+    """RequestScheduler spaces reads, merges them and survives cancels."""
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), SlowHandler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+        self.host = '127.0.0.1:%d' % self.server.server_address[1]
+
+    def tearDown(self):
+        helpers.close_sessions()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def url(self, endpoint):
+        """Returns the url of an endpoint of the test server."""
+        return 'http://%s/YamahaExtendedControl/v1/%s' % (
+            self.host, endpoint)
+
+    def test_commands_are_not_spaced(self):
+        """Only the reads wait for the rate limit."""
+        scheduler = helpers.RequestScheduler('test', rate_limit=2)
+        first = scheduler.acquire(helpers.PRIORITY_REFRESH).result()
+        scheduler.release()
+        read = scheduler.acquire(helpers.PRIORITY_REFRESH)
+        command = scheduler.acquire(helpers.PRIORITY_COMMAND).result(0.1)
+        self.assertFalse(read.done())
+        scheduler.release()
+        self.assertLess(command - first, 0.1)
+        self.assertGreaterEqual(read.result(1) - first, 0.5)
+        scheduler.release()
+
+    def test_cancelled_merged_read(self):
+        """A cancelled merged caller does not fail the owner."""
+        results = {}
+
+        def call(name, endpoint):
+            """Send a request from a thread."""
+            results[name] = helpers.request(self.url(endpoint))
+
+        busy = threading.Thread(target=call,
+                                args=('busy', 'main/setVolume'))
+        busy.start()
+        time.sleep(0.05)
+        owner = threading.Thread(target=call,
+                                 args=('owner', 'main/getStatus'))
+        owner.start()
+        time.sleep(0.05)
+
+        async def merged():
+            task = asyncio.ensure_future(
+                helpers.async_request(self.url('main/getStatus')))
+            await asyncio.sleep(0.05)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+
+        asyncio.run(merged())
+        busy.join()
+        owner.join()
+        self.assertEqual(results['owner'], {'response_code': 0})
+
+    def test_cancelled_read_owner(self):
+        """A cancelled owner still answers the callers merged into it."""
+        busy = threading.Thread(target=helpers.request,
+                                args=(self.url('main/setVolume'),))
+        busy.start()
+        time.sleep(0.05)
+
+        async def scenario():
+            owner = asyncio.ensure_future(
+                helpers.async_request(self.url('main/getStatus')))
+            await asyncio.sleep(0.05)
+            merged = asyncio.ensure_future(
+                helpers.async_request(self.url('main/getStatus')))
+            await asyncio.sleep(0.01)
+            owner.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await owner
+            result = await asyncio.wait_for(merged, 2)
+            await helpers.async_close_sessions()
+            return result
+
+        self.assertEqual(asyncio.run(scenario()), {'response_code': 0})
+        busy.join()
+
+
+class FakeDevice:
+    """Records the events it handles, slowly if asked to."""
+
+    def __init__(self, device_id, delay=0):
+        self.device_id = device_id
+        self.ip_address = device_id
+        self.delay = delay
+        self.handled = []
+
+    def handle_event(self, data):
+        """Record an event."""
+        time.sleep(self.delay)
+        self.handled.append((time.monotonic(), data))
+
+
+class EventListenerTest(unittest.TestCase):
+    """EventListener dispatches the events of every device."""
+
+    def test_duplicate_is_an_immediate_repeat(self):
+        """A value coming back after another one is not a duplicate."""
+        listener = helpers.EventListener(0)
+        addr = ('192.168.1.20', 41100)
+        volume_20 = b'{"main": {"volume": 20}}'
+        volume_21 = b'{"main": {"volume": 21}}'
+        self.assertFalse(listener.duplicate(volume_20, addr))
+        self.assertTrue(listener.duplicate(volume_20, addr))
+        self.assertFalse(listener.duplicate(volume_21, addr))
+        self.assertFalse(listener.duplicate(volume_20, addr))
+        self.assertFalse(listener.duplicate(volume_20, ('192.168.1.21', 1)))
+        listener.stop_dispatch()
+
+    def test_failed_event_keeps_dispatching(self):
+        """An error handling an event does not stop the next ones."""
+        listener = helpers.EventListener(0)
+        device = FakeDevice('device')
+        handle_event = device.handle_event
+        calls = []
+
+        def failing(data):
+            calls.append(data)
+            if len(calls) == 1:
+                raise ZeroDivisionError('division by zero')
+            handle_event(data)
+
+        device.handle_event = failing
+        listener.register(device)
+        with self.assertLogs(helpers._LOGGER, 'ERROR'):
+            listener.dispatch('device', {'main': {'volume': 30}})
+            time.sleep(0.1)
+        listener.dispatch('device', {'main': {'volume': 31}})
+        listener.stop_dispatch(wait=True)
+        self.assertEqual([data for _, data in device.handled],
+                         [{'main': {'volume': 31}}])
+
+    def test_slow_device_does_not_block(self):
+        """The events of a device wait only for that device."""
+        listener = helpers.EventListener(0, coalesce_window=0.01)
+        slow = FakeDevice('slow', delay=1)
+        fast = FakeDevice('fast')
+        listener.register(slow)
+        listener.register(fast)
+        worker = threading.Thread(target=helpers.message_worker,
+                                  args=(listener,))
+        worker.start()
+        listener.enqueue(b'{"device_id": "slow", "dist": {}}')
+        time.sleep(0.1)
+        start = time.monotonic()
+        listener.enqueue(b'{"device_id": "fast", "main": {"volume": 1}}')
+        listener.enqueue(b'{"device_id": "slow", "main": {"volume": 1}}')
+        time.sleep(0.1)
+        listener.enqueue(b'{"device_id": "slow", "main": {"mute": true}}')
+        listener.enqueue(None)
+        worker.join()
+        listener.stop_dispatch(wait=True)
+        self.assertLess(fast.handled[0][0] - start, 0.5)
+        # The events arriving while the slow device was busy were merged
+        self.assertEqual([data for _, data in slow.handled], [
+            {'device_id': 'slow', 'dist': {}},
+            {'device_id': 'slow', 'main': {'volume': 1, 'mute': True}}])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+"""End-to-end benchmark of the integration against simulated devices.
+
+For every fleet size it measures the discovery time, the startup time,
+the command latency, the event-to-state propagation and the group
+formation time. It needs
+the same Python environment as the integration (Home Assistant and the
+pymusiccast requirement). Run it from the repository root:
+
+    python tools/benchmark.py --sizes 1,10,50,100 --latency 0.02
+"""
+import argparse
+import os
+import socket
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from custom_components.musiccast_yamaha import discovery  # noqa: E402
+from custom_components.musiccast_yamaha import helpers  # noqa: E402
+from custom_components.musiccast_yamaha import pymusiccast  # noqa: E402
+from simulator import SimulatedFleet  # noqa: E402
+
+TIMEOUT = 10
+# Every simulated device answers on its own loopback address
+SUBNET = '127.0.1.0/24'
+
+
+class Player:
+    """Stands in for the Home Assistant entity of a zone."""
+
+    def __init__(self):
+        self.power = None
+        self.status = None
+        self._source = None
+        self.source_list = []
+        self.volume = 0
+        self.volume_max = 0
+        self.mute = False
+        self.media_status = None
+        self.changed = threading.Condition()
+
+    def update_hass(self):
+        """Wake up the waiters."""
+        with self.changed:
+            self.changed.notify_all()
+        return True
+
+    def wait_for(self, predicate):
+        """Wait until the pushed state satisfies predicate."""
+        with self.changed:
+            return self.changed.wait_for(predicate, TIMEOUT)
+
+    def new_media_status(self, status):
+        """Record the media status."""
+        self.media_status = status
+
+    def new_play_time(self, play_time):
+        """Ignore the playback position."""
+
+    def group_changed(self):
+        """Wake up the waiters."""
+        self.update_hass()
+
+    def update_master(self, group_id):
+        """Ignore the clients leaving."""
+
+
+def free_port(kind=socket.SOCK_DGRAM):
+    """Returns a free UDP or TCP port."""
+    with socket.socket(socket.AF_INET, kind) as sock:
+        sock.bind(('', 0))
+        return sock.getsockname()[1]
+
+
+def percentiles(samples):
+    """Returns the median and 95th percentile in milliseconds."""
+    if not samples:
+        return float('nan'), float('nan')
+    samples = sorted(samples)
+    p95 = samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+    return statistics.median(samples) * 1000, p95 * 1000
+
+
+def bench_fleet(size, options):
+    """Run every measure against a fleet of size devices."""
+    http_port = free_port(socket.SOCK_STREAM)
+    fleet = SimulatedFleet(size, subnet=SUBNET, port=http_port,
+                           **options).start()
+    port = free_port()
+    result = {'devices': size}
+    try:
+        start = time.monotonic()
+        found = discovery.discover(discovery.subnet_hosts(SUBNET, http_port))
+        result['discovery'] = time.monotonic() - start
+        result['found'] = len(found)
+
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=size) as executor:
+            devices = list(executor.map(
+                lambda host: pymusiccast.McDevice(host, udp_port=port),
+                [device['host'] for device in found]))
+        result['startup'] = time.monotonic() - start
+
+        players = []
+        for device in devices:
+            player = Player()
+            device.set_yamaha_device(player)
+            device.zones['main'].set_yamaha_device(player)
+            device.update_status()
+            players.append(player)
+
+        latencies = []
+        propagation = []
+        for step, (device, player) in enumerate(zip(devices, players)):
+            volume = 30 + step % 50
+            start = time.monotonic()
+            device.zones['main'].set_volume(volume)
+            latencies.append(time.monotonic() - start)
+            expected = volume / player.volume_max
+            if player.wait_for(lambda p=player, v=expected: p.volume == v):
+                propagation.append(time.monotonic() - start)
+        result['command'] = percentiles(latencies)
+        result['event'] = percentiles(propagation)
+        result['events_lost'] = size - len(propagation)
+
+        if len(devices) > 1:
+            server = devices[0]
+            clients = [device.ip_address for device in devices[1:9]]
+            start = time.monotonic()
+            server.zones['main'].distribution_group_add(clients)
+            formed = players[0].wait_for(
+                lambda: pymusiccast.GROUPS.clients(server.ip_address) ==
+                sorted(clients))
+            result['group'] = (time.monotonic() - start
+                               if formed else float('nan'))
+            server.zones['main'].distribution_group_stop()
+            players[0].wait_for(
+                lambda: not pymusiccast.GROUPS.clients(server.ip_address))
+        else:
+            result['group'] = float('nan')
+    finally:
+        helpers.close_listeners()
+        helpers.close_sessions()
+        pymusiccast.DEVICES.clear()
+        fleet.stop()
+    return result
+
+
+def main():
+    """Run the benchmark for every fleet size and print a table."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', default='1,10,25,50,100',
+                        help="comma separated fleet sizes")
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--loss', type=float, default=0.0)
+    args = parser.parse_args()
+    options = {'latency': args.latency, 'jitter': args.jitter,
+               'loss': args.loss}
+
+    print("%7s %6s %11s %10s %19s %19s %6s %9s" % (
+        'devices', 'found', 'discovery s', 'startup s', 'command p50/p95 ms',
+        'event p50/p95 ms', 'lost', 'group s'))
+    for size in [int(size) for size in args.sizes.split(',')]:
+        result = bench_fleet(size, options)
+        print("%7d %6d %11.3f %10.3f %9.1f/%9.1f %9.1f/%9.1f %6d %9.3f" % (
+            result['devices'], result['found'], result['discovery'],
+            result['startup'],
+            result['command'][0], result['command'][1],
+            result['event'][0], result['event'][1],
+            result['events_lost'], result['group']))
+
+
+if __name__ == '__main__':
+    main()
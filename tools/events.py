@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+"""Record and replay the UDP event streams of MusicCast devices.
+
+record subscribes to the events of real devices and writes every datagram
+with its arrival time and source address to a capture file, like the
+musiccast_yamaha.record_events service does. replay feeds a capture into
+the event dispatch pipeline of the integration, talking to simulated
+devices carrying the captured device ids, and reports the throughput and
+the per-event processing time. It needs the same Python environment as
+the integration. Run it from the repository root:
+
+    python tools/events.py record --host 192.168.1.20 events.mcev
+    python tools/events.py replay events.mcev --speed 10
+"""
+import argparse
+import json
+import os
+import socket
+import sys
+import threading
+import time
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from custom_components.musiccast_yamaha import helpers  # noqa: E402
+from custom_components.musiccast_yamaha import pymusiccast  # noqa: E402
+from custom_components.musiccast_yamaha.const import ENDPOINTS  # noqa: E402
+from benchmark import Player, free_port, percentiles  # noqa: E402
+from simulator import SimulatedFleet  # noqa: E402
+
+# Devices forget a subscription after 10 minutes without getStatus
+SUBSCRIBE_INTERVAL = 300
+ZONES = ('main', 'zone2', 'zone3', 'zone4')
+SUBNET = '127.0.1.0/24'
+
+
+def subscribe(hosts, port):
+    """Ask every host to push its events to port."""
+    headers = {'X-AppName': 'MusicCast/0.1(python)', 'X-AppPort': str(port)}
+    for host in hosts:
+        try:
+            requests.get(ENDPOINTS['getStatus'].format(host, 'main'),
+                         headers=headers, timeout=5)
+        except requests.RequestException as err:
+            print("%s: Could not subscribe: %s" % (host, err))
+
+
+def record(args):
+    """Record the events of the hosts until the duration elapsed."""
+    recorder = helpers.EventRecorder(args.capture)
+    deadline = time.monotonic() + args.duration
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                        helpers.EVENT_RECEIVE_BUFFER)
+        sock.settimeout(helpers.SOCKET_TIMEOUT)
+        sock.bind(('', args.port))
+        renew = 0
+        try:
+            while time.monotonic() < deadline:
+                if time.monotonic() >= renew:
+                    subscribe(args.host, args.port)
+                    renew = time.monotonic() + SUBSCRIBE_INTERVAL
+                try:
+                    data, addr = sock.recvfrom(helpers.EVENT_BUFFER_SIZE)
+                except socket.timeout:
+                    continue
+                recorder.record(data, addr)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            recorder.close()
+    print("Recorded %d events to %s" % (recorder.count, args.capture))
+
+
+def capture_devices(datagrams):
+    """Returns the device ids and the zones seen in a capture."""
+    device_ids = set()
+    zones = set()
+    for _, _, data in datagrams:
+        try:
+            event = json.loads(data.decode('utf-8'))
+        except ValueError:
+            continue
+        if 'device_id' in event:
+            device_ids.add(event['device_id'])
+            zones.update(zone for zone in ZONES if zone in event)
+    return sorted(device_ids), [zone for zone in ZONES if zone in zones]
+
+
+def timed(obj, name, samples):
+    """Record the duration of every call of a method of obj."""
+    method = getattr(obj, name)
+
+    def wrapper(*args, **kwargs):
+        """Call the method and record its duration."""
+        start = time.monotonic()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            samples.append(time.monotonic() - start)
+
+    setattr(obj, name, wrapper)
+
+
+def replay(args):
+    """Feed a capture into the dispatch pipeline and report its cost."""
+    datagrams = list(helpers.read_capture(args.capture))
+    device_ids, zones = capture_devices(datagrams)
+    if not device_ids:
+        print("%s holds no device event" % args.capture)
+        return
+    fleet = SimulatedFleet(len(device_ids), subnet=SUBNET,
+                           port=free_port(socket.SOCK_STREAM),
+                           zones=zones or ['main'],
+                           latency=args.latency)
+    for simulated, device_id in zip(fleet.devices, device_ids):
+        simulated.device_id = device_id
+    fleet.start()
+    listener = helpers.EventListener(0, args.coalesce_window)
+    samples = {'handle_event': [], 'update_distribution_info': []}
+    try:
+        port = free_port()
+        for host in fleet.hosts:
+            device = pymusiccast.McDevice(host, udp_port=port)
+            device.set_yamaha_device(Player())
+            for zone in device.zones.values():
+                zone.set_yamaha_device(Player())
+                timed(zone, 'update_distribution_info',
+                      samples['update_distribution_info'])
+            device.update_status()
+            timed(device, 'handle_event', samples['handle_event'])
+            listener.register(device)
+
+        worker = threading.Thread(name="Replay", target=helpers.message_worker,
+                                  args=(listener,))
+        worker.start()
+        first = datagrams[0][0]
+        start = time.monotonic()
+        for offset, addr, data in datagrams:
+            if args.speed:
+                delay = start + (offset - first) / args.speed - \
+                    time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            listener.receive(data, addr)
+        listener.enqueue(None)
+        worker.join()
+        listener.stop_dispatch(wait=True)
+        elapsed = time.monotonic() - start
+    finally:
+        helpers.close_listeners()
+        helpers.close_sessions()
+        pymusiccast.DEVICES.clear()
+        fleet.stop()
+
+    drops = helpers.METRICS.snapshot()['queues'].get(listener.name, {})
+    capture_time = datagrams[-1][0] - first
+    print("%d events of %d devices over %.3f s replayed in %.3f s" % (
+        len(datagrams), len(device_ids), capture_time, elapsed))
+    print("throughput: %.1f events/s, %d duplicates and %d overflows "
+          "dropped" % (len(datagrams) / elapsed if elapsed else float('inf'),
+                       drops.get('duplicates', 0), drops.get('overflows', 0)))
+    print("%24s %7s %9s %9s %9s" % ('', 'calls', 'p50 ms', 'p95 ms',
+                                    'max ms'))
+    for name, durations in samples.items():
+        median, p95 = percentiles(durations)
+        print("%24s %7d %9.2f %9.2f %9.2f" % (
+            name, len(durations), median, p95,
+            max(durations) * 1000 if durations else float('nan')))
+
+
+def main():
+    """Run the record or replay command."""
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    recorder = commands.add_parser('record', help="capture device events")
+    recorder.add_argument('capture')
+    recorder.add_argument('--host', action='append', required=True,
+                          help="device to subscribe to, can be repeated")
+    recorder.add_argument('--port', type=int, default=5005,
+                          help="UDP port the events are pushed to")
+    recorder.add_argument('--duration', type=float, default=60,
+                          help="seconds to record")
+    recorder.set_defaults(func=record)
+
+    replayer = commands.add_parser('replay', help="replay a capture")
+    replayer.add_argument('capture')
+    replayer.add_argument('--speed', type=float, default=1.0,
+                          help="replay N times faster, 0 for as fast as "
+                          "possible")
+    replayer.add_argument('--latency', type=float, default=0.0,
+                          help="seconds added to every simulated response")
+    replayer.add_argument('--coalesce-window', type=float,
+                          default=helpers.DEFAULT_COALESCE_WINDOW)
+    replayer.set_defaults(func=replay)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,340 @@
+#!/usr/bin/env python
+"""Local simulator of Yamaha MusicCast devices.
+
+Every simulated device serves the YamahaExtendedControl endpoints used by
+the integration over HTTP on 127.0.0.1 and pushes UDP events to the port
+registered through the X-AppPort header, like a real speaker does.
+"""
+import argparse
+import ipaddress
+import json
+import logging
+import random
+import socket
+import struct
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+_LOGGER = logging.getLogger(__name__)
+
+NULL_GROUP = '00000000000000000000000000000000'
+INPUTS = ['net_radio', 'server', 'spotify', 'usb', 'bluetooth', 'hdmi1',
+          'aux', 'mc_link']
+ALBUM_ART_URL = '/art.png'
+API_PREFIX = '/YamahaExtendedControl/v1/'
+
+
+def png_chunk(kind, data):
+    """Returns a PNG chunk."""
+    return (struct.pack('!I', len(data)) + kind + data +
+            struct.pack('!I', zlib.crc32(kind + data)))
+
+
+def album_art(size=64):
+    """Returns a gray PNG image of size x size pixels."""
+    rows = b''.join(b'\x00' + b'\x80' * size for _ in range(size))
+    return (b'\x89PNG\r\n\x1a\n' +
+            png_chunk(b'IHDR', struct.pack('!IIBBBBB', size, size, 8, 0, 0,
+                                           0, 0)) +
+            png_chunk(b'IDAT', zlib.compress(rows)) +
+            png_chunk(b'IEND', b''))
+
+
+ALBUM_ART = album_art()
+
+
+class SimulatedDevice:
+    """A MusicCast device answering on its own HTTP port."""
+
+    def __init__(self, name, zones=('main',), latency=0.0, jitter=0.0,
+                 loss=0.0, address='127.0.0.1', port=0):
+        self.name = name
+        self.device_id = '%012X' % random.randrange(16**12)
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.requests = 0
+        self.subscribers = set()
+        self.zones = {zone_id: {'power': 'on', 'input': 'net_radio',
+                                'volume': 20, 'max_volume': 161,
+                                'mute': False}
+                      for zone_id in zones}
+        self.play_info = {'input': 'net_radio', 'playback': 'play',
+                          'artist': 'Artist', 'album': 'Album',
+                          'track': 'Track', 'albumart_url': ALBUM_ART_URL,
+                          'play_time': 0, 'total_time': 240}
+        self.dist = {'group_id': NULL_GROUP, 'group_name': '',
+                     'role': 'none', 'server_zone': 'main',
+                     'client_list': []}
+        self._lock = threading.Lock()
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._server = ThreadingHTTPServer((address, port),
+                                           self._handler_class())
+        self._server.daemon_threads = True
+
+    @property
+    def host(self):
+        """Returns the host:port the device answers on."""
+        return '%s:%d' % self._server.server_address[:2]
+
+    def start(self):
+        """Serve requests in a background thread."""
+        thread = threading.Thread(name="Simulator-%s" % self.name,
+                                  target=self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        """Stop serving requests."""
+        self._server.shutdown()
+        self._server.server_close()
+        self._socket.close()
+
+    def delay(self):
+        """Wait like a slow embedded web server."""
+        delay = self.latency + random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+    def send_event(self, event):
+        """Push an event to every subscriber, losing some of them."""
+        event = dict(event, device_id=self.device_id)
+        data = json.dumps(event).encode('utf-8')
+        for address in list(self.subscribers):
+            if random.random() < self.loss:
+                continue
+            try:
+                self._socket.sendto(data, address)
+            except OSError as err:
+                _LOGGER.debug("%s: Could not send event: %s", self.name, err)
+
+    def handle(self, path, params, payload, headers, client_ip):
+        """Returns the response to a request."""
+        self.requests += 1
+        parts = path.strip('/').split('/')
+        if len(parts) < 2:
+            return {'response_code': 3}
+        section, command = parts[-2], parts[-1]
+        if command == 'getStatus' and headers.get('X-AppPort'):
+            self.subscribers.add((client_ip, int(headers['X-AppPort'])))
+        with self._lock:
+            if section == 'system':
+                return self.handle_system(command)
+            if section == 'netusb':
+                return self.handle_netusb(command, params)
+            if section == 'dist':
+                return self.handle_dist(command, params, payload)
+            if section in self.zones:
+                return self.handle_zone(section, command, params)
+        return {'response_code': 3}
+
+    def handle_system(self, command):
+        """Answer the system requests."""
+        if command == 'getDeviceInfo':
+            return {'model_name': 'SIM-1', 'device_id': self.device_id,
+                    'system_version': 1.0, 'api_version': 2.0}
+        if command == 'getNetworkStatus':
+            return {'network_name': self.name}
+        if command == 'getLocationInfo':
+            return {'zone_list': {zone_id: True for zone_id in self.zones}}
+        if command == 'getFeatures':
+            return {'zone': [{'id': zone_id, 'input_list': list(INPUTS)}
+                             for zone_id in self.zones]}
+        return {'response_code': 3}
+
+    def handle_zone(self, zone_id, command, params):
+        """Answer the zone requests, pushing an event on changes."""
+        zone = self.zones[zone_id]
+        if command == 'getStatus':
+            return dict(zone)
+        changes = {}
+        if command == 'setPower':
+            changes['power'] = params.get('power', 'on')
+        elif command == 'setInput':
+            changes['input'] = params.get('input')
+        elif command == 'setVolume':
+            changes['volume'] = min(int(params.get('volume', 0)),
+                                    zone['max_volume'])
+        elif command == 'setMute':
+            changes['mute'] = params.get('enable') == 'true'
+        else:
+            return {'response_code': 3}
+        zone.update(changes)
+        self.send_event({zone_id: changes})
+        if 'input' in changes:
+            self.play_info['input'] = changes['input']
+            self.send_event({'netusb': {'play_info_updated': True}})
+        return {}
+
+    def handle_netusb(self, command, params):
+        """Answer the netusb requests."""
+        if command == 'getPlayInfo':
+            return dict(self.play_info)
+        if command == 'setPlayback':
+            playback = params.get('playback')
+            if playback in ('play', 'pause', 'stop'):
+                self.play_info['playback'] = playback
+            self.send_event({'netusb': {'play_info_updated': True}})
+            return {}
+        return {'response_code': 3}
+
+    def handle_dist(self, command, params, payload):
+        """Answer the distribution requests."""
+        if command == 'getDistributionInfo':
+            return dict(self.dist)
+        if command == 'setClientInfo':
+            group_id = payload.get('group_id') or NULL_GROUP
+            self.dist.update(group_id=group_id,
+                             role='client' if payload.get('group_id')
+                             else 'none')
+            zone = payload.get('zone', 'main')
+            if zone in self.zones and payload.get('group_id'):
+                self.zones[zone].update(input='mc_link', power='on')
+        elif command == 'setServerInfo':
+            group_id = payload.get('group_id') or NULL_GROUP
+            clients = [c['ip_address'] for c in self.dist['client_list']]
+            if payload.get('type') == 'add':
+                clients += [c for c in payload.get('client_list', [])
+                            if c not in clients]
+            elif payload.get('type') == 'remove':
+                clients = [c for c in clients
+                           if c not in payload.get('client_list', [])]
+            else:
+                clients = []
+            self.dist.update(
+                group_id=group_id,
+                role='server' if payload.get('group_id') else 'none',
+                client_list=[{'ip_address': c} for c in clients])
+        elif command == 'setGroupName':
+            self.dist['group_name'] = payload.get('name', '')
+        elif command not in ('startDistribution', 'stopDistribution'):
+            return {'response_code': 3}
+        self.send_event({'dist': {'dist_info_updated': True}})
+        return {}
+
+    def _handler_class(self):
+        """Returns the request handler bound to this device."""
+        device = self
+
+        class Handler(BaseHTTPRequestHandler):
+            """Handle the YamahaExtendedControl requests."""
+
+            protocol_version = 'HTTP/1.1'
+            # The headers and the body go out as separate writes, keep the
+            # delayed ACK of the client from holding back the body
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                """Answer a request."""
+                url = urlparse(self.path)
+                if not url.path.startswith(API_PREFIX):
+                    self.send_album_art(url.path)
+                    return
+                params = {key: values[-1] for key, values
+                          in parse_qs(url.query).items()}
+                payload = {}
+                length = int(self.headers.get('Content-Length') or 0)
+                if length:
+                    try:
+                        payload = json.loads(self.rfile.read(length))
+                    except ValueError:
+                        payload = {}
+                device.delay()
+                response = device.handle(url.path, params, payload,
+                                         self.headers, self.client_address[0])
+                response.setdefault('response_code', 0)
+                body = json.dumps(response).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            do_POST = do_GET
+
+            def send_album_art(self, path):
+                """Answer an album art request, 404 for other paths."""
+                device.delay()
+                if path != ALBUM_ART_URL:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'image/png')
+                self.send_header('Content-Length', str(len(ALBUM_ART)))
+                self.end_headers()
+                self.wfile.write(ALBUM_ART)
+
+            def log_message(self, *args):
+                """Keep the output quiet."""
+
+        return Handler
+
+
+class SimulatedFleet:
+    """N simulated devices."""
+
+    def __init__(self, size, subnet=None, port=0, **options):
+        addresses = (list(ipaddress.ip_network(subnet).hosts())
+                     if subnet else ['127.0.0.1'] * size)
+        if len(addresses) < size:
+            raise ValueError("%s is too small for %d devices" %
+                             (subnet, size))
+        self.devices = [SimulatedDevice('Speaker %d' % index,
+                                        address=str(addresses[index]),
+                                        port=port, **options)
+                        for index in range(size)]
+
+    @property
+    def hosts(self):
+        """Returns the host:port of every device."""
+        return [device.host for device in self.devices]
+
+    def start(self):
+        """Start every device."""
+        for device in self.devices:
+            device.start()
+        return self
+
+    def stop(self):
+        """Stop every device."""
+        for device in self.devices:
+            device.stop()
+
+
+def main():
+    """Run a fleet until interrupted."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--devices', type=int, default=1)
+    parser.add_argument('--zones', default='main',
+                        help="comma separated zones of every device")
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help="seconds added to every response")
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help="random seconds added or removed")
+    parser.add_argument('--loss', type=float, default=0.0,
+                        help="probability of losing a UDP event")
+    parser.add_argument('--subnet',
+                        help="give every device its own loopback address "
+                        "of this subnet, e.g. 127.0.1.0/24")
+    parser.add_argument('--port', type=int, default=0,
+                        help="HTTP port of every device with --subnet")
+    args = parser.parse_args()
+
+    fleet = SimulatedFleet(args.devices, subnet=args.subnet, port=args.port,
+                           zones=args.zones.split(','),
+                           latency=args.latency, jitter=args.jitter,
+                           loss=args.loss).start()
+    for device in fleet.devices:
+        print("%s: %s (%s)" % (device.name, device.host, device.device_id))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        fleet.stop()
+
+
+if __name__ == '__main__':
+    main()